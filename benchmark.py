@@ -0,0 +1,178 @@
+import numpy as np
+import pandas as pd
+import logging
+import os
+import time
+import argparse
+import params
+import margin_lib as mlib
+
+##############################
+# Setup Logging Configuration
+##############################
+logger = logging.getLogger(os.path.basename(__file__))
+if not len(logger.handlers):
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s|%(name)s === %(message)s ===', datefmt='%Y-%m-%d %I:%M:%S')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+###############################
+
+
+def time_call(func, *args):
+    """Run func once and return its result and elapsed seconds"""
+
+    start = time.time()
+    result = func(*args)
+
+    return result, time.time() - start
+
+
+def loop_concentration_similarity(CR):
+    """Reference double loop formerly used by build_in_bucket_correlation"""
+
+    F = np.zeros((len(CR), len(CR)))
+
+    for i in range(len(CR)):
+        for j in range(len(CR)):
+            CRi = CR[i]
+            CRj = CR[j]
+
+            F[i][j] = min(CRi, CRj) / max(CRi, CRj)
+
+    return F
+
+
+def loop_currency_correlation(pos_delta, params):
+    """Reference double loop formerly used by build_bucket_correlation for IR delta and vega"""
+
+    all_curr = pos_delta.Group.unique()
+    g = np.ones((len(all_curr), len(all_curr)))
+
+    for i in range(len(all_curr)):
+        for j in range(len(all_curr)):
+            CRi = pos_delta.iloc[[i]].CR.values[0]
+            CRj = pos_delta.iloc[[j]].CR.values[0]
+
+            g[i][j] = min(CRi, CRj) / max(CRi, CRj)
+
+    g = g * params.IR_Gamma
+    np.fill_diagonal(g, 0)
+
+    return g
+
+
+def bench_in_bucket_correlation(num_credit_issuers, num_equity_names):
+    """Time the concentration similarity of a large CreditQ and Equity delta bucket"""
+
+    np.random.seed(0)
+
+    buckets = [('CreditQ', '2', num_credit_issuers, len(params.CreditQ_Tenor) * params.CreditQ_num_sec_type),
+               ('Equity', '7', num_equity_names, 1)]
+
+    for risk_class, bucket, num_qualifiers, num_factors in buckets:
+        qualifiers = ['Q{0:05d}'.format(i) for i in range(num_qualifiers)]
+        pos_gp = pd.DataFrame({'RiskClass': risk_class, 'Bucket': bucket, 'Qualifier': qualifiers})
+        CR = np.repeat(np.random.uniform(1, 3, num_qualifiers), num_factors)
+
+        F_loop, t_loop = time_call(loop_concentration_similarity, CR)
+        F, t_vec = time_call(mlib.build_concentration_similarity, CR)
+        Corr, t_corr = time_call(mlib.build_in_bucket_correlation, pos_gp, params, 'Delta', CR)
+
+        logger.info('{0} bucket with {1} qualifiers, {2} factors: loop {3:.3f}s, vectorized {4:.3f}s, speed-up {5:.0f}x, '
+                    'max diff {6}, in-bucket correlation {7:.3f}s'.format(
+                        risk_class, num_qualifiers, len(CR), t_loop, t_vec, t_loop / max(t_vec, 1e-9),
+                        np.abs(F - F_loop).max(), t_corr))
+
+
+def bench_structured_in_bucket_K(num_credit_issuers):
+    """Time K of a large CreditQ delta bucket with the dense and the factored correlation"""
+
+    np.random.seed(0)
+
+    num_factors = len(params.CreditQ_Tenor) * params.CreditQ_num_sec_type
+    qualifiers = ['Q{0:05d}'.format(i) for i in range(num_credit_issuers)]
+    pos_gp = pd.DataFrame({'RiskClass': 'CreditQ', 'Bucket': '2', 'Qualifier': qualifiers})
+    CR = np.repeat(np.random.uniform(1, 3, num_credit_issuers), num_factors)
+    WS = np.random.normal(0, 1e6, num_credit_issuers * num_factors)
+
+    def dense_K():
+        Corr = mlib.build_in_bucket_correlation(pos_gp, params, 'Delta', CR)
+        return np.sqrt(np.dot(WS, np.dot(Corr, WS)))
+
+    def structured_K():
+        Corr = mlib.build_in_bucket_structure(pos_gp, params, 'Delta', CR)
+        return np.sqrt(Corr.quadratic_form(WS))
+
+    K_dense, t_dense = time_call(dense_K)
+    K_structured, t_structured = time_call(structured_K)
+
+    logger.info('CreditQ bucket with {0} issuers, {1} factors: dense K {2:.3f}s ({3:.0f}MB matrix), '
+                'factored K {4:.4f}s, speed-up {5:.0f}x, relative diff {6}'.format(
+                    num_credit_issuers, len(WS), t_dense, len(WS) ** 2 * 8 / 1e6, t_structured,
+                    t_dense / max(t_structured, 1e-9), abs(K_dense - K_structured) / K_dense))
+
+
+def bench_bucket_correlation(num_currencies):
+    """Time the IR inter-currency correlation of a portfolio against the former double loop"""
+
+    np.random.seed(0)
+
+    currencies = ['C{0:03d}'.format(i) for i in range(num_currencies)]
+    pos_delta = pd.DataFrame({'RiskClass': 'IR', 'Group': currencies, 'CR': np.random.uniform(1, 3, num_currencies)})
+
+    g_loop, t_loop = time_call(loop_currency_correlation, pos_delta, params)
+    g, t_vec = time_call(mlib.build_bucket_correlation, pos_delta, params, 'Delta')
+
+    logger.info('IR bucket correlation of {0} currencies: loop {1:.3f}s, vectorized {2:.5f}s, speed-up {3:.0f}x, '
+                'max diff {4}'.format(num_currencies, t_loop, t_vec, t_loop / max(t_vec, 1e-9), np.abs(g - g_loop).max()))
+
+
+def bench_quadratic_form(num_calls):
+    """Time the per-bucket x * C * x' against the former np.mat triple product"""
+
+    np.random.seed(0)
+
+    def mat_product(x, C):
+        K = np.mat(x) * np.mat(C) * np.mat(np.reshape(x, (len(x), 1)))
+        return K.item(0)
+
+    # IR vega, IR USD delta with inflation, commodity buckets and a mid-sized credit bucket
+    for n in [12, 73, 16, 500]:
+        C = np.random.uniform(0, 1, (n, n))
+        C = (C + C.T) / 2
+        np.fill_diagonal(C, 1)
+        x = np.random.normal(0, 1e6, n)
+
+        def run(func):
+            for i in range(num_calls):
+                value = func(x, C)
+            return value
+
+        value_mat, t_mat = time_call(run, mat_product)
+        value_kernel, t_kernel = time_call(run, mlib.quadratic_form)
+
+        logger.info('Quadratic form n={0}: np.mat {1:.2f}us, kernel {2:.2f}us per call, speed-up {3:.1f}x, '
+                    'relative diff {4}'.format(n, t_mat / num_calls * 1e6, t_kernel / num_calls * 1e6,
+                                               t_mat / max(t_kernel, 1e-9), abs(value_mat - value_kernel) / abs(value_mat)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SIMM Benchmarks.')
+    parser.add_argument('--credit-issuers', dest='credit_issuers', type=int, default=500, help='issuers in the CreditQ bucket')
+    parser.add_argument('--equity-names', dest='equity_names', type=int, default=2000, help='names in the Equity bucket')
+    parser.add_argument('--calls', dest='calls', type=int, default=10000, help='calls per quadratic form benchmark')
+    parser.add_argument('--currencies', dest='currencies', type=int, default=40, help='currencies in the IR bucket correlation')
+    args = parser.parse_args()
+
+    bench_in_bucket_correlation(args.credit_issuers, args.equity_names)
+    bench_structured_in_bucket_K(args.credit_issuers)
+    bench_bucket_correlation(args.currencies)
+    bench_quadratic_form(args.calls)
+
+    return
+
+if __name__ == '__main__':
+    main()
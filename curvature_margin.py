@@ -1,8 +1,5 @@
-import numpy as np
-import pandas as pd
 import os
 import logging
-import math
 import re
 import margin_lib as mlib
 from vega_margin import VegaMargin
@@ -57,7 +54,7 @@ class CurvatureMargin(object):
 
     def input_scaling(self, pos):
 
-        pos = pos.groupby(['Label1']).apply(self.calc_scaling)
+        pos = pos.groupby(['Label1'], observed=True).apply(self.calc_scaling)
         pos['AmountUSD'] = pos['AmountUSD'] * pos['SF']
 
         return pos
@@ -68,36 +65,41 @@ class CurvatureMargin(object):
     def build_risk_factors(self, pos_gp, params):
         return self.__vega_loader.build_risk_factors(pos_gp, params)
 
+    def build_risk_factor_index(self, pos_gp, params):
+        return self.__vega_loader.build_risk_factor_index(pos_gp, params)
+
+    def build_risk_factor_scale(self, pos_gp, params, CR):
+        """dWS / ds of every risk factor, WS = s"""
+
+        return 1.0
+
     def calculate_CR_Threshold(self, gp, params):
         return self.__vega_loader.calculate_CR_Threshold(gp, params)
 
     def calculate_risk_group(self, gp, params):
         return self.__vega_loader.calculate_risk_group(gp, params)
 
-    def calculate_CR_Threshold(self, gp, params):
-        return self.__vega_loader.calculate_CR_Threshold(gp, params)
-
-    def margin_risk_group(self, gp, params):
+    def build_weighted_risk(self, gp, params):
 
         risk_class = gp.RiskClass.unique()[0]
 
         if risk_class in ['IR', 'FX']:
-            logger.info('Calculate {0} Curvature Margin for {1}'.format(risk_class, gp.Qualifier.unique()))
+            logger.info('Calculate {0} Curvature Margin for {1}'.format(risk_class, list(gp.Qualifier.unique())))
         else:
-            logger.info('Calculate {0} Curvature Margin for {1}'.format(risk_class, gp.Bucket.unique()))
-
-        gp = gp.apply(self.calculate_risk_group, axis=1, params=params)
-        gp = self.calculate_CR_Threshold(gp, params)
+            logger.info('Calculate {0} Curvature Margin for {1}'.format(risk_class, list(gp.Bucket.unique())))
 
         s = self.build_risk_factors(gp, params)
         CR = mlib.build_concentration_risk(gp, params, self.margin_type())
 
         WS = s
 
-        Corr = mlib.build_in_bucket_correlation(gp, params, self.margin_type(), CR)
+        Corr = mlib.build_in_bucket_structure(gp, params, self.margin_type(), CR)
+
+        return gp, WS, CR, Corr
 
-        K = np.mat(WS) * np.mat(Corr) * np.mat(np.reshape(WS, (len(WS), 1)))
-        K = math.sqrt(K.item(0))
+    def build_margin_risk_group(self, gp, WS, CR, K):
+
+        risk_class = gp.RiskClass.unique()[0]
 
         ret = gp[['CombinationID', 'ProductClass', 'RiskType', 'RiskClass']].copy()
         ret.drop_duplicates(inplace=True)
@@ -114,4 +116,4 @@ class CurvatureMargin(object):
         else:
             ret['Group'] = gp['Bucket'].unique()[0]
 
-        return ret
\ No newline at end of file
+        return ret
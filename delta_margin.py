@@ -2,7 +2,6 @@ import numpy as np
 import pandas as pd
 import os
 import logging
-import math
 import margin_lib as mlib
 
 ##############################
@@ -37,7 +36,7 @@ class DeltaMargin(object):
         if risk_class == 'IR':
             factor_group = ['CombinationID', 'ProductClass', 'RiskType', 'Qualifier', 'Bucket', 'Label1', 'Label2', 'RiskClass']
         elif risk_class == 'CreditQ':
-            pos.ix[pos.Label2.isnull(), 'Label2'] = 'Non_Sec'
+            pos.loc[pos.Label2.isnull(), 'Label2'] = 'Non_Sec'
             factor_group = ['CombinationID', 'ProductClass', 'RiskType', 'Qualifier', 'Bucket', 'Label1', 'Label2', 'RiskClass']
         elif risk_class == 'CreditNonQ':
             factor_group = ['CombinationID', 'ProductClass', 'RiskType', 'Qualifier', 'Bucket', 'Label1', 'RiskClass']
@@ -46,46 +45,28 @@ class DeltaMargin(object):
         elif risk_class == 'FX':
             factor_group = ['CombinationID', 'ProductClass', 'RiskType', 'Qualifier', 'RiskClass']
 
-        pos_gp = pos.groupby(factor_group)
-        pos_delta = pos_gp.agg({'AmountUSD': np.sum})
+        # observed groups of categorical labels are sorted explicitly
+        pos_gp = pos.groupby(factor_group, observed=True)
+        pos_delta = pos_gp.agg({'AmountUSD': np.sum}).sort_index()
         pos_delta.reset_index(inplace=True)
 
         # if there exists inflation, need to aggregate amount by each currency
         pos_inflation = pos[pos.RiskType == 'Risk_Inflation'].copy()
         if len(pos_inflation) > 0:
-            pos_inflation = pos_inflation.groupby(['CombinationID', 'ProductClass', 'RiskType', 'Qualifier', 'RiskClass']).agg({'AmountUSD': np.sum})
+            pos_inflation = pos_inflation.groupby(['CombinationID', 'ProductClass', 'RiskType', 'Qualifier', 'RiskClass'], observed=True).agg({'AmountUSD': np.sum}).sort_index()
             pos_inflation.reset_index(inplace=True)
 
             pos_delta = pd.concat([pos_delta, pos_inflation])
 
         return pos_delta
 
-    def find_factor_idx(self, tenor_factor, curve_factor, tenors, curves, risk_class):
-        idx = 0
-
-        if risk_class == 'IR':
-            for tenor in tenors:
-                for curve in curves:
-                    if tenor_factor == tenor and curve_factor == curve:
-                        return idx
-                    else:
-                        idx = idx + 1
-
-        elif risk_class in ['CreditQ', 'CreditNonQ']:
-            for tenor in tenors:
-                if tenor_factor == tenor:
-                    return idx
-                else:
-                    idx = idx + 1
-
-        return -1
-
-    def build_risk_factors(self, pos_gp, params):
+    def build_risk_factor_index(self, pos_gp, params):
+        """Risk factor of every netted row, -1 for rows outside the factor grid, and the number of factors"""
 
         risk_class = pos_gp.RiskClass.unique()[0]
 
         if risk_class == 'IR':
-            pos_inflation = pos_gp[pos_gp.RiskType == 'Risk_Inflation'].copy()
+            is_inflation = (pos_gp.RiskType == 'Risk_Inflation').values
 
             gp_curr = pos_gp.Qualifier.unique()[0]
 
@@ -93,64 +74,63 @@ class DeltaMargin(object):
             if gp_curr == 'USD':
                 curve = params.IR_USD_Sub_Curve
 
-            s = np.zeros(len(params.IR_Tenor) * len(curve))
-            if len(pos_inflation) > 0:
-                s = np.zeros(len(params.IR_Tenor) * len(curve) + 1)
+            num_factors = len(params.IR_Tenor) * len(curve)
 
-            for i, row in pos_gp.iterrows():
-                idx = self.find_factor_idx(row['Label1'], row['Label2'], params.IR_Tenor, curve, risk_class)
-                if idx >= 0:
-                    s[idx] = row['AmountUSD']
+            # factors are laid out tenor by tenor, sub curves within a tenor
+            tenor_idx = mlib.build_factor_index(pos_gp.Label1.values, params.IR_Tenor)
+            curve_idx = mlib.build_factor_index(pos_gp.Label2.values, curve)
+            idx = np.where((tenor_idx >= 0) & (curve_idx >= 0), tenor_idx * len(curve) + curve_idx, -1)
 
-            if len(pos_inflation) > 0:
-                s[len(s) - 1] = pos_inflation.AmountUSD
+            # inflation is the last factor
+            if is_inflation.any():
+                idx[is_inflation] = num_factors
+                num_factors = num_factors + 1
 
         elif risk_class == 'CreditQ':
             tenors = params.CreditQ_Tenor
 
+            # qualifiers in sorted order, each with non securitized then securitized tenors
+            qualifier_idx = pd.Categorical(pos_gp.Qualifier.values, categories=np.sort(pos_gp.Qualifier.unique())).codes
+            sec_idx = mlib.build_factor_index(pos_gp.Label2.values, ['Non_Sec', 'Sec'])
+            tenor_idx = mlib.build_factor_index(pos_gp.Label1.values, tenors)
+
             # 2 for securitization
-            s = np.zeros(pos_gp.Qualifier.nunique() * params.CreditQ_num_sec_type * len(tenors))
+            num_factors = pos_gp.Qualifier.nunique() * params.CreditQ_num_sec_type * len(tenors)
 
-            pos_gp.sort_values(['Qualifier', 'Label2'], inplace=True, ascending=True)
+            idx = (qualifier_idx * params.CreditQ_num_sec_type + sec_idx) * len(tenors) + tenor_idx
+            idx = np.where((tenor_idx >= 0) & (sec_idx >= 0), idx, -1)
 
-            for j in range(pos_gp.Qualifier.nunique()):
-                pos_gp_qualifier = pos_gp[pos_gp.Qualifier == pos_gp.Qualifier.unique()[j]].copy()
+        elif risk_class == 'CreditNonQ':
+            tenors = params.CreditNonQ_Tenor
 
-                pos_gp_qualifier_non_sec = pos_gp_qualifier[pos_gp_qualifier.Label2 == 'Non_Sec'].copy()
+            qualifier_idx = pd.Categorical(pos_gp.Qualifier.values, categories=np.sort(pos_gp.Qualifier.unique())).codes
+            tenor_idx = mlib.build_factor_index(pos_gp.Label1.values, tenors)
 
-                for i, row in pos_gp_qualifier_non_sec.iterrows():
-                    idx = self.find_factor_idx(row['Label1'], [], tenors, [], risk_class)
-                    if idx >= 0:
-                        s[idx + j * len(tenors) * params.CreditQ_num_sec_type] = row['AmountUSD']
+            num_factors = pos_gp.Qualifier.nunique() * len(tenors)
 
-                pos_gp_qualifier_sec = pos_gp_qualifier[pos_gp_qualifier.Label2 == 'Sec'].copy()
+            idx = np.where(tenor_idx >= 0, qualifier_idx * len(tenors) + tenor_idx, -1)
 
-                for i, row in pos_gp_qualifier_sec.iterrows():
-                    idx = self.find_factor_idx(row['Label1'], [], tenors, [], risk_class)
-                    if idx >= 0:
-                        s[idx + j * len(tenors) * params.CreditQ_num_sec_type + len(tenors)] = row['AmountUSD']
+        else:
+            num_factors = pos_gp.Qualifier.nunique()
 
-        elif risk_class == 'CreditNonQ':
-            tenors = params.CreditNonQ_Tenor
+            # one factor per row, in the row order the concentration risk follows
+            idx = pos_gp.index.values
 
-            s = np.zeros(pos_gp.Qualifier.nunique() * len(tenors))
+        return idx, num_factors
 
-            for j in range(pos_gp.Qualifier.nunique()):
-                pos_gp_qualifier = pos_gp[
-                    pos_gp.Qualifier == pos_gp.sort_values(['Qualifier']).Qualifier.unique()[j]].copy()
+    def build_risk_factors(self, pos_gp, params):
+        idx, num_factors = self.build_risk_factor_index(pos_gp, params)
+        valid = idx >= 0
 
-                for i, row in pos_gp_qualifier.iterrows():
-                    idx = self.find_factor_idx(row['Label1'], [], tenors, [], risk_class)
-                    if idx >= 0:
-                        s[idx + j * len(tenors)] = row['AmountUSD']
+        s = np.zeros(num_factors)
+        np.add.at(s, idx[valid], pos_gp.AmountUSD.values[valid])
 
-        else:
-            s = np.zeros(pos_gp.Qualifier.nunique())
+        return s
 
-            for i, row in pos_gp.iterrows():
-                s[i] = row['AmountUSD']
+    def build_risk_factor_scale(self, pos_gp, params, CR):
+        """dWS / ds of every risk factor, WS = RW * s * CR"""
 
-        return s
+        return self.build_risk_weights(pos_gp, params) * CR
 
     def build_risk_weights(self, pos_gp, params):
         risk_class = pos_gp.RiskClass.unique()[0]
@@ -159,7 +139,7 @@ class DeltaMargin(object):
             bucket = pd.DataFrame(pos_gp.Bucket.unique(), columns=['curr_type'])
             RW = pd.merge(bucket, params.IR_Weights, left_on=['curr_type'], right_on=['curr'], how='inner')
             RW = RW.drop(['curr_type', 'curr'], axis=1)
-            RW = RW.as_matrix()
+            RW = RW.values
 
             gp_curr = pos_gp.Qualifier.unique()[0]
 
@@ -200,130 +180,107 @@ class DeltaMargin(object):
 
         return RW
 
-    def calculate_risk_group(self, gp, params):
-        if gp['RiskClass'] == 'IR':
-            if gp['Qualifier'] in params.IR_Low_Vol_Curr:
-                risk_group = 'Low volatility'
-            elif gp['Qualifier'] in params.IR_Reg_Vol_Less_Well_Traded_Curr:
-                risk_group = 'Regular volatility, less well-traded'
-            elif gp['Qualifier'] in params.IR_Reg_Vol_Well_Traded_Curr:
-                risk_group = 'Regular volatility, well-traded'
-            else:
-                risk_group = 'High volatility'
-
-        elif gp['RiskClass'] == 'CreditQ':
-            if gp['Bucket'] in params.CreditQ_CR_Sov_incl_Central_Banks:
-                risk_group = 'Sovereigns including central banks'
-            elif gp['Bucket'] in params.CreditQ_CR_Corp_Entities:
-                risk_group = 'Corporate entities'
-            elif gp['Bucket'] in params.CreditQ_CR_Not_Classified:
-                risk_group = 'Not classified'
-
-        elif gp['RiskClass'] == 'CreditNonQ':
-            if gp['Bucket'] in params.CreditNonQ_CR_IG:
-                risk_group = 'IG (RMBS and CMBS)'
-            elif gp['Bucket'] in params.CreditNonQ_CR_HY_Non_Rated:
-                risk_group = 'HY/Non-rated (RMBS and CMBS)'
-            elif gp['Bucket'] in params.CreditNonQ_CR_Not_Classified:
-                risk_group = 'Not classified'
-
-        elif gp['RiskClass'] == 'Equity':
-            if gp['Bucket'] in params.Equity_CR_Emerging_Large_Cap:
-                risk_group = 'Emerging Markets - Large Cap'
-            elif gp['Bucket'] in params.Equity_CR_Developed_Large_Cap:
-                risk_group = 'Developed Markets - Large Cap'
-            elif gp['Bucket'] in params.Equity_CR_Emerging_Small_Cap:
-                risk_group = 'Emerging Markets - Small Cap'
-            elif gp['Bucket'] in params.Equity_CR_Developed_Small_Cap:
-                risk_group = 'Developed Markets - Small Cap'
-            elif gp['Bucket'] in params.Equity_CR_Index_Funds_ETF:
-                risk_group = 'Indexeds, Funds, ETFs'
-            elif gp['Bucket'] in params.Equity_CR_Not_Classified:
-                risk_group = 'Not classified'
-
-        elif gp['RiskClass'] == 'Commodity':
-            if gp['Bucket'] in params.Commodity_CR_Coal:
-                risk_group = 'Coal'
-            elif gp['Bucket'] in params.Commodity_CR_Crude_Oil:
-                risk_group = 'Crude Oil'
-            elif gp['Bucket'] in params.Commodity_CR_Light_End:
-                risk_group = 'Light ends'
-            elif gp['Bucket'] in params.Commodity_CR_Middle_Distilates:
-                risk_group = 'Middle Distilates'
-            elif gp['Bucket'] in params.Commodity_CR_Heavy_Distilates:
-                risk_group = 'Heavy Distilates'
-            elif gp['Bucket'] in params.Commodity_CR_NA_Natual_Gas:
-                risk_group = 'NA Natural gas'
-            elif gp['Bucket'] in params.Commodity_CR_EU_Natual_Gas:
-                risk_group = 'EU Natual gas'
-            elif gp['Bucket'] in params.Commodity_CR_NA_Power:
-                risk_group = 'NA Power, On-Peak'
-            elif gp['Bucket'] in params.Commodity_CR_EU_Power:
-                risk_group = 'EU Power, On-Peak'
-            elif gp['Bucket'] in params.Commodity_CR_Freight:
-                risk_group = 'Freight, Dry or Wet'
-            elif gp['Bucket'] in params.Commodity_CR_Base_Metals:
-                risk_group = 'Base metals'
-            elif gp['Bucket'] in params.Commodity_CR_Precious_Metals:
-                risk_group = 'Precious Metals'
-            elif gp['Bucket'] in params.Commodity_CR_Grains:
-                risk_group = 'Grains'
-            elif gp['Bucket'] in params.Commodity_CR_Softs:
-                risk_group = 'Softs'
-            elif gp['Bucket'] in params.Commodity_CR_Livestock:
-                risk_group = 'Livestock'
-            elif gp['Bucket'] in params.Commodity_CR_Others:
-                risk_group = 'Other / Diversified Commodity Indices'
-
-        elif gp['RiskClass'] == 'FX':
-            if gp['Qualifier'] in params.FX_Significantly_Material:
-                risk_group = 'C1'
-            elif gp['Qualifier'] in params.FX_Frequently_Traded:
-                risk_group ='C2'
-            else:
-                risk_group = 'C3'
+    def build_risk_group_table(self, params):
+        """Risk_Group lookup of every risk class: RiskClass -> (column, {value: Risk_Group}, default)"""
+
+        IR_groups = {}
+        for curr in params.IR_Low_Vol_Curr:
+            IR_groups.setdefault(curr, 'Low volatility')
+        for curr in params.IR_Reg_Vol_Less_Well_Traded_Curr:
+            IR_groups.setdefault(curr, 'Regular volatility, less well-traded')
+        for curr in params.IR_Reg_Vol_Well_Traded_Curr:
+            IR_groups.setdefault(curr, 'Regular volatility, well-traded')
+
+        CreditQ_groups = mlib.build_bucket_groups([
+            (params.CreditQ_CR_Sov_incl_Central_Banks, 'Sovereigns including central banks'),
+            (params.CreditQ_CR_Corp_Entities, 'Corporate entities'),
+            (params.CreditQ_CR_Not_Classified, 'Not classified')])
+
+        CreditNonQ_groups = mlib.build_bucket_groups([
+            (params.CreditNonQ_CR_IG, 'IG (RMBS and CMBS)'),
+            (params.CreditNonQ_CR_HY_Non_Rated, 'HY/Non-rated (RMBS and CMBS)'),
+            (params.CreditNonQ_CR_Not_Classified, 'Not classified')])
+
+        Equity_groups = mlib.build_bucket_groups([
+            (params.Equity_CR_Emerging_Large_Cap, 'Emerging Markets - Large Cap'),
+            (params.Equity_CR_Developed_Large_Cap, 'Developed Markets - Large Cap'),
+            (params.Equity_CR_Emerging_Small_Cap, 'Emerging Markets - Small Cap'),
+            (params.Equity_CR_Developed_Small_Cap, 'Developed Markets - Small Cap'),
+            (params.Equity_CR_Index_Funds_ETF, 'Indexeds, Funds, ETFs'),
+            (params.Equity_CR_Not_Classified, 'Not classified')])
+
+        Commodity_groups = mlib.build_bucket_groups([
+            (params.Commodity_CR_Coal, 'Coal'),
+            (params.Commodity_CR_Crude_Oil, 'Crude Oil'),
+            (params.Commodity_CR_Light_End, 'Light ends'),
+            (params.Commodity_CR_Middle_Distilates, 'Middle Distilates'),
+            (params.Commodity_CR_Heavy_Distilates, 'Heavy Distilates'),
+            (params.Commodity_CR_NA_Natual_Gas, 'NA Natural gas'),
+            (params.Commodity_CR_EU_Natual_Gas, 'EU Natual gas'),
+            (params.Commodity_CR_NA_Power, 'NA Power, On-Peak'),
+            (params.Commodity_CR_EU_Power, 'EU Power, On-Peak'),
+            (params.Commodity_CR_Freight, 'Freight, Dry or Wet'),
+            (params.Commodity_CR_Base_Metals, 'Base metals'),
+            (params.Commodity_CR_Precious_Metals, 'Precious Metals'),
+            (params.Commodity_CR_Grains, 'Grains'),
+            (params.Commodity_CR_Softs, 'Softs'),
+            (params.Commodity_CR_Livestock, 'Livestock'),
+            (params.Commodity_CR_Others, 'Other / Diversified Commodity Indices')])
+
+        FX_groups = mlib.build_bucket_groups([
+            (params.FX_Significantly_Material, 'C1'),
+            (params.FX_Frequently_Traded, 'C2')])
+
+        return {
+            'IR': ('Qualifier', IR_groups, 'High volatility'),
+            'CreditQ': ('Bucket', CreditQ_groups, None),
+            'CreditNonQ': ('Bucket', CreditNonQ_groups, None),
+            'Equity': ('Bucket', Equity_groups, None),
+            'Commodity': ('Bucket', Commodity_groups, None),
+            'FX': ('Qualifier', FX_groups, 'C3'),
+        }
 
-        gp['Risk_Group'] = risk_group
+    def calculate_risk_group(self, gp, params):
+        table = mlib.load_risk_group_table(self, params)
+        gp['Risk_Group'] = mlib.map_risk_group(gp, table)
 
         return gp
 
-    def calculate_CR_Threshold(self, gp, params):
+    def calculate_CR_Threshold(self, pos, params):
 
-        risk_group = gp['RiskClass'].unique()[0]
+        risk_group = pos['RiskClass'].unique()[0]
 
         if risk_group == 'IR':
-            thrd = params.IR_CR_Thrd[params.IR_CR_Thrd.Type == 'Delta'].copy()
+            thrd = params.IR_CR_Thrd[params.IR_CR_Thrd.Type == 'Delta']
 
         elif risk_group == 'CreditQ':
-            thrd = params.CreditQ_CR_Thrd[params.CreditQ_CR_Thrd.Type == 'Delta'].copy()
+            thrd = params.CreditQ_CR_Thrd[params.CreditQ_CR_Thrd.Type == 'Delta']
 
         elif risk_group == 'CreditNonQ':
-            thrd = params.CreditNonQ_CR_Thrd[params.CreditNonQ_CR_Thrd.Type == 'Delta'].copy()
+            thrd = params.CreditNonQ_CR_Thrd[params.CreditNonQ_CR_Thrd.Type == 'Delta']
 
         elif risk_group == 'Equity':
-            thrd = params.Equity_CR_Thrd[params.Equity_CR_Thrd.Type == 'Delta'].copy()
+            thrd = params.Equity_CR_Thrd[params.Equity_CR_Thrd.Type == 'Delta']
 
         elif risk_group == 'Commodity':
-            thrd = params.Commodity_CR_Thrd[params.Commodity_CR_Thrd.Type == 'Delta'].copy()
+            thrd = params.Commodity_CR_Thrd[params.Commodity_CR_Thrd.Type == 'Delta']
 
         elif risk_group == 'FX':
-            thrd = params.FX_CR_Thrd[params.FX_CR_Thrd.Type == 'Delta'].copy()
+            thrd = params.FX_CR_Thrd[params.FX_CR_Thrd.Type == 'Delta']
 
-        gp = pd.merge(gp, thrd[['Risk_Group', 'CR_THR']], how='left')
+        thrd = pd.Series(thrd.CR_THR.values, index=thrd.Risk_Group.values)
+        pos['CR_THR'] = pos.Risk_Group.map(thrd).values
 
-        return gp
+        return pos
 
-    def margin_risk_group(self, gp, params):
+    def build_weighted_risk(self, gp, params):
 
         risk_class = gp.RiskClass.unique()[0]
 
         if risk_class in ['IR', 'FX']:
-            logger.info('Calculate {0} Delta Margin for {1}'.format(risk_class, gp.Qualifier.unique()))
+            logger.info('Calculate {0} Delta Margin for {1}'.format(risk_class, list(gp.Qualifier.unique())))
         else:
-            logger.info('Calculate {0} Delta Margin for {1}'.format(risk_class, gp.Bucket.unique()))
-
-        gp = gp.apply(self.calculate_risk_group, axis=1, params=params)
-        gp = self.calculate_CR_Threshold(gp, params)
+            logger.info('Calculate {0} Delta Margin for {1}'.format(risk_class, list(gp.Bucket.unique())))
 
         s = self.build_risk_factors(gp, params)
         RW = self.build_risk_weights(gp, params)
@@ -331,10 +288,13 @@ class DeltaMargin(object):
 
         WS = RW * s * CR
 
-        Corr = mlib.build_in_bucket_correlation(gp, params, self.__margin, CR)
+        Corr = mlib.build_in_bucket_structure(gp, params, self.__margin, CR)
 
-        K = np.mat(WS) * np.mat(Corr) * np.mat(np.reshape(WS, (len(WS), 1)))
-        K = math.sqrt(K.item(0))
+        return gp, WS, CR, Corr
+
+    def build_margin_risk_group(self, gp, WS, CR, K):
+
+        risk_class = gp.RiskClass.unique()[0]
 
         if gp.RiskType.nunique() > 1:
             risk_type = '_'.join(gp.RiskType.unique())
@@ -360,5 +320,3 @@ class DeltaMargin(object):
             ret['Group'] = gp['Bucket'].unique()[0]
 
         return ret
-
-
@@ -1,9 +1,16 @@
+import numpy as np
 import pandas as pd
 import logging
 import os
 import params
 import simm_lib
+import margin_lib as mlib
+import simm_engine
+import simm_store
 import argparse
+import multiprocessing
+import shutil
+import tempfile
 
 ##############################
 # Setup Logging Configuration
@@ -24,26 +31,25 @@ if not len(logger.handlers):
 ###############################
 
 
-def main():
-    # Setup input argument
-    parser = argparse.ArgumentParser(description='SIMM Calculation.')
-    parser.add_argument('-f', dest='input_file', type=str, required=True, help='simm input csv file')
-    #args = parser.parse_args(['-f' 'simm_config.xlsx'])
-    args = parser.parse_args()
+def log_correlation_cache():
+    """Log the reuse of correlations by this process"""
 
-    # Create output directory for product and risk class
-    simm_lib.prep_output_directory(params)
+    cache = mlib.Correlation_Cache
+    logger.info('Correlation cache of process {0}: {1} hits, {2} misses'.format(os.getpid(), cache.hits, cache.misses))
 
-    # Read input file with specified data type
-    #input_file = 'simm_input_1.csv'
-    input_file = args.input_file
 
-    trades_simm = simm_lib.generate_trade_pos(input_file, params)
-    run_cases = simm_lib.generate_run_cases(input_file, trades_simm)
+def calculate_run_cases(run_cases, batch):
+    """Calculate SIMM of run cases in run case order"""
 
-    # Calculate SIMM and dump output
-    simm_all = []
-    if len(run_cases) > 0:
+    if batch:
+        logger.info('Run {0} tests in batch'.format(run_cases.CombinationID.nunique()))
+        simm_all = simm_lib.calculate_simm(run_cases, params)
+
+        # Keep the output in run case order
+        simm_all = simm_all.set_index('CombinationID').loc[run_cases.CombinationID.unique()]
+        simm_all.reset_index(inplace=True)
+    else:
+        simm_all = []
         for case in run_cases.CombinationID.unique():
             logger.info('Run test {0}'.format(case))
             run_case = run_cases[run_cases.CombinationID == case].copy()
@@ -51,13 +57,154 @@ def main():
             simm_all.append(simm)
 
         simm_all = pd.concat(simm_all)
-        simm_all.to_csv('simm_output.csv', index=False)
 
-        for index, row in simm_all.iterrows():
-            logger.info('{0}: Total SIMM is {1:,}'.format(row['CombinationID'], int(round(row['SIMM_Benchmark']))))
+    log_correlation_cache()
+
+    return simm_all
+
+
+def allocate_run_cases(run_cases):
+    """Calculate SIMM of run cases and allocate it to their sensitivities"""
+
+    logger.info('Allocate SIMM of {0} tests to sensitivities'.format(run_cases.CombinationID.nunique()))
+    engine = simm_engine.IncrementalSIMM(run_cases, params)
+
+    allocation = engine.allocate()
+    allocation.to_csv('simm_allocation.csv', index=False)
+
+    # Keep the output in run case order
+    simm_all = engine.simm().set_index('CombinationID').loc[run_cases.CombinationID.unique()]
+    simm_all.reset_index(inplace=True)
+
+    log_correlation_cache()
+
+    return simm_all
+
+
+def init_worker():
+    """Worker processes load the calibration tables they use from the compiled config cache on first access"""
+
+    logger.info('Worker {0} started, loading calibration tables on first use'.format(os.getpid()))
+
+
+def run_task(task):
+    """Calculate a chunk of run cases, returning the intermediate results buffered by the task"""
+
+    store_path, start, end, batch, file_format = task
+
+    # Map the shared sensitivity store and materialize only the combinations of this task
+    run_cases = simm_store.SensitivityStore(store_path).load(start, end)
+
+    sink = simm_lib.ResultsSink(file_format)
+    simm_lib.set_results_sink(sink)
+
+    simm_all = calculate_run_cases(run_cases, batch)
+
+    return simm_all, sink.tables
+
 
+def calculate_run_cases_parallel(run_cases, batch, workers):
+    """Spread run cases across a process pool and merge results in run case order"""
+
+    work_path = tempfile.mkdtemp(prefix='simm_tasks_', dir=os.getcwd())
+    try:
+        # Workers attach to one memory-mapped copy of the run cases instead of receiving pickled frames
+        store = simm_store.SensitivityStore.create(run_cases, os.path.join(work_path, 'store'))
+
+        cases = store.cases
+        num_tasks = min(len(cases), workers * 4)
+        case_chunks = [chunk for chunk in np.array_split(np.arange(len(cases)), num_tasks) if len(chunk) > 0]
+
+        tasks = []
+        for chunk in case_chunks:
+            tasks.append((store.path, chunk[0], chunk[-1] + 1, batch, simm_lib.results_sink.file_format))
+
+        logger.info('Run {0} tests in {1} tasks on {2} workers'.format(len(cases), len(tasks), workers))
+
+        pool = multiprocessing.Pool(workers, initializer=init_worker)
+        try:
+            results = pool.map(run_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(work_path)
+
+    # Intermediate results of the tasks go to the sink in task order
+    simm_all = []
+    for simm, tables in results:
+        simm_all.append(simm)
+        simm_lib.results_sink.extend(tables)
+
+    return pd.concat(simm_all)
+
+
+def main():
+    # Setup input argument
+    parser = argparse.ArgumentParser(description='SIMM Calculation.')
+    parser.add_argument('-f', dest='input_file', type=str, required=True, help='simm input xlsx, parquet or feather file')
+    parser.add_argument('--batch', dest='batch', action='store_true', help='calculate all run cases in one pass')
+    parser.add_argument('--workers', dest='workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--allocate', dest='allocate', action='store_true', help='allocate SIMM to sensitivities, not with --stream')
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help='net a large csv or crif sensitivity file in chunks, dropping SensitivityIDs')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=100000, help='rows per chunk with --stream')
+    parser.add_argument('--intermediate-format', dest='intermediate_format', choices=simm_lib.ResultsSink.Formats, default='csv',
+                        help='file format of the intermediate margin results')
+    parser.add_argument('--no-intermediate', dest='intermediate', action='store_false', help='skip the intermediate margin results')
+    #args = parser.parse_args(['-f' 'simm_config.xlsx'])
+    args = parser.parse_args()
+
+    # Netted risk factors have no SensitivityIDs to allocate to
+    if args.stream and args.allocate:
+        parser.error('--allocate can not be used with --stream')
+
+    # Create output directory for product and risk class
+    simm_lib.prep_output_directory(params)
+
+    parallel = args.workers > 1 and not args.allocate
+
+    # Write intermediate results on a background thread while the margin calculation goes on, except
+    # when a process pool is forked: workers return their results, written once the pool is done
+    if not args.intermediate:
+        simm_lib.set_results_sink(simm_lib.ResultsSink(None))
+    elif parallel:
+        simm_lib.set_results_sink(simm_lib.ResultsSink(args.intermediate_format))
     else:
-        logger.info('No trade has SIMM')
+        simm_lib.set_results_sink(simm_lib.BackgroundResultsSink(args.intermediate_format))
+
+    try:
+        # Read input file with specified data type
+        #input_file = 'simm_input_1.csv'
+        input_file = args.input_file
+
+        if args.stream:
+            run_cases = simm_lib.stream_trade_pos(input_file, params, args.chunk_size)
+        else:
+            input_source = simm_lib.open_input(input_file)
+            trades_simm = simm_lib.generate_trade_pos(input_source, params)
+            run_cases = simm_lib.generate_run_cases(input_source, trades_simm)
+
+        # Calculate SIMM and dump output
+        if len(run_cases) > 0:
+            if args.allocate:
+                simm_all = allocate_run_cases(run_cases)
+            elif parallel:
+                simm_all = calculate_run_cases_parallel(run_cases, args.batch, args.workers)
+            else:
+                simm_all = calculate_run_cases(run_cases, args.batch)
+
+            simm_all.to_csv('simm_output.csv', index=False)
+
+            for index, row in simm_all.iterrows():
+                logger.info('{0}: Total SIMM is {1:,}'.format(row['CombinationID'], int(round(row['SIMM_Benchmark']))))
+
+        else:
+            logger.info('No trade has SIMM')
+
+    finally:
+        # Wait for the intermediate results, a failed write is raised here
+        simm_lib.results_sink.close()
 
     return
 
@@ -2,7 +2,7 @@ import numpy as np
 import pandas as pd
 import os
 import logging
-import math
+import collections
 
 ##############################
 # Setup Logging Configuration
@@ -22,19 +22,131 @@ if not len(logger.handlers):
     logger.addHandler(file_handler)
 ###############################
 
-def build_concentration_risk(pos_gp, params, margin):
-    risk_class = pos_gp.RiskClass.unique()[0]
+# Number of matrix entries computed per block by build_concentration_similarity
+SIMILARITY_BLOCK_ELEMENTS = 2 ** 20
 
-    pos_gp_CR = pos_gp.groupby(['Qualifier', 'Risk_Group']).agg({'AmountUSD': np.sum, 'CR_THR': np.average})
-    pos_gp_CR.reset_index(inplace=True)
-    pos_gp_CR['CR'] = pos_gp_CR.apply(lambda d: max(1, math.sqrt(abs(d['AmountUSD']) / d['CR_THR'])), axis=1)
+# Label lookup tables built once per label list by build_factor_index
+Factor_Indices = {}
 
-    if risk_class == 'IR':
-        CR = pos_gp_CR['CR'].values
+def build_factor_index(values, labels):
+    """Position of every value in the label list, -1 when it is not a known label"""
+
+    key = tuple(labels)
+    if key not in Factor_Indices:
+        Factor_Indices[key] = pd.Index(labels)
+
+    return Factor_Indices[key].get_indexer(values)
+
+# Risk_Group lookup tables built once per margin type and parameter set
+Risk_Group_Tables = {}
+
+def build_bucket_groups(bucket_lists):
+    """{bucket: Risk_Group} from (bucket list, Risk_Group) pairs, earlier pairs taking precedence"""
+
+    groups = {}
+    for buckets, risk_group in bucket_lists:
+        for bucket in buckets:
+            groups.setdefault(bucket, risk_group)
+
+    return groups
+
+def load_risk_group_table(margin_loader, params):
+    """Risk_Group lookup table of a margin type, built on first use"""
+
+    key = (type(margin_loader).__name__, id(params))
+    if key not in Risk_Group_Tables:
+        Risk_Group_Tables[key] = margin_loader.build_risk_group_table(params)
+
+    return Risk_Group_Tables[key]
+
+class CorrelationCache(object):
+    """Least recently used correlations keyed by the structural parameters they are built from
+
+    Cached arrays are made read-only as every bucket with the same key shares them. hits and misses
+    count the lookups since the cache was last cleared.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build, *args):
+        """Correlation of key, built by build(*args) on a miss"""
+
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+
+        value = build(*args)
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+
+        self.entries[key] = value
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        return value
 
-    elif risk_class in ['CreditQ', 'CreditNonQ']:
-        CR = pos_gp_CR['CR'].values
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
 
+# In-bucket IR and inter-bucket correlations shared across buckets and combinations
+Correlation_Cache = CorrelationCache()
+
+def map_risk_group(pos, table):
+    """Risk_Group of every row from a RiskClass -> (column, {value: Risk_Group}, default) lookup table
+
+    A callable default classifies all values missing from the mapping of a call at once, leaving the
+    shared mapping unchanged.
+    """
+
+    risk_group = pd.Series(None, index=pos.index, dtype=object)
+
+    for risk_class in pos.RiskClass.unique():
+        column, mapping, default = table[risk_class]
+        is_class = (pos.RiskClass == risk_class).values
+        values = pos.loc[is_class, column].astype(object)
+
+        groups = values.map(mapping)
+        if callable(default):
+            is_missing = groups.isnull().values
+            if is_missing.any():
+                groups = groups.astype(object)
+                groups[is_missing] = default(values[is_missing])
+        elif default is not None:
+            groups = groups.fillna(default)
+
+        risk_group[is_class] = groups.values
+
+    return risk_group.values
+
+def attach_concentration_risk(pos, params, margin_loader, keys):
+    """Attach Risk_Group, CR_THR and CR = max(1, sqrt(|sum S| / T)) per keys group to the whole position frame"""
+
+    pos = margin_loader.calculate_risk_group(pos, params)
+    pos = margin_loader.calculate_CR_Threshold(pos, params)
+
+    amount = pos.groupby(keys, sort=False, observed=True).AmountUSD.transform(np.sum).values.astype(np.float64)
+    pos['CR'] = np.fmax(1, np.sqrt(np.abs(amount) / pos.CR_THR.values.astype(np.float64)))
+
+    return pos
+
+def build_concentration_risk(pos_gp, params, margin):
+    """Slice the precomputed CR of a bucket: one per qualifier in sorted order, repeated per factor for credit"""
+
+    risk_class = pos_gp.RiskClass.unique()[0]
+
+    qualifiers, first = np.unique(pos_gp.Qualifier.values, return_index=True)
+    CR = pos_gp.CR.values[first]
+
+    if risk_class in ['CreditQ', 'CreditNonQ']:
         if risk_class == 'CreditQ':
             tenors = params.CreditQ_Tenor
         else:
@@ -47,57 +159,198 @@ def build_concentration_risk(pos_gp, params, margin):
 
         CR = np.repeat(CR, num_factors)
 
-    else:
-        pos_gp_CR = pd.merge(pos_gp, pos_gp_CR[['Qualifier', 'Risk_Group', 'CR']], how='left')
-        CR = pos_gp_CR['CR']
-        CR = CR.values
-
     return CR
 
-def build_in_bucket_correlation(pos_gp, params, margin, CR):
-    risk_class = pos_gp.RiskClass.unique()[0]
-    if risk_class not in ['IR', 'FX']:
-        bucket = pos_gp.Bucket.unique()[0]
+def build_concentration_similarity(CR, dtype=np.float64):
+    """F[i][j] = min(CRi, CRj) / max(CRi, CRj), broadcast in row blocks to bound temporaries"""
 
-    if risk_class == 'IR':
-        gp_curr = pos_gp.Qualifier.unique()[0]
-        curve = params.IR_Sub_Curve
-        if gp_curr == 'USD':
-            curve = params.IR_USD_Sub_Curve
+    CR = np.ravel(np.asarray(CR, dtype=dtype))
+    n = len(CR)
 
-        fai = np.zeros((len(curve), len(curve)))
-        fai.fill(params.IR_Fai)
-        np.fill_diagonal(fai, 1)
+    F = np.empty((n, n), dtype=dtype)
 
-        if margin == 'Vega' or margin == 'Curvature':
-            fai = 1
+    block = max(1, SIMILARITY_BLOCK_ELEMENTS // max(n, 1))
+    for start in range(0, n, block):
+        CR_block = CR[start:start + block, np.newaxis]
+        np.minimum(CR_block, CR, out=F[start:start + block])
+        F[start:start + block] /= np.maximum(CR_block, CR)
 
-        rho = params.IR_Corr
-        if margin == 'Curvature':
-            rho = rho * rho
+    return F
+
+class QualifierBlockCorrelation(object):
+    """In-bucket correlation of qualifiers owning consecutive blocks of factors, kept in factored form
+
+    Off the diagonal Corr[i][j] = rho * min(CRa, CRb) / max(CRa, CRb) for factors i, j of qualifiers
+    a, b, where rho is same_rho within a qualifier and diff_rho across qualifiers. The diagonal is 1.
+    Products with Corr take O(n log n) time and O(n) memory instead of a dense (n x n) matrix.
+    """
+
+    def __init__(self, same_rho, diff_rho, CR, num_factors):
+        self.same_rho = same_rho
+        self.diff_rho = diff_rho
+        self.CR = np.ravel(np.asarray(CR, dtype=np.float64))
+        self.num_factors = num_factors
+        self.order = np.argsort(self.CR, kind='mergesort')
+
+    def stack_key(self):
+        return None
+
+    def similarity_dot(self, u):
+        """F * u for F[a][b] = min(CRa, CRb) / max(CRa, CRb), using prefix sums over sorted CR"""
+
+        CR = self.CR[self.order]
+        v = u[self.order]
+
+        lower = np.cumsum(CR * v) / CR
+        v_CR = v / CR
+        upper = np.cumsum(v_CR[::-1])[::-1] - v_CR
+
+        Fu = np.empty(len(u))
+        Fu[self.order] = lower + CR * upper
+
+        return Fu
+
+    def dot(self, x):
+        x = np.ravel(np.asarray(x, dtype=np.float64))
+
+        # Sum of factors per qualifier
+        u = x.reshape(-1, self.num_factors).sum(axis=1)
+        Ru = self.diff_rho * self.similarity_dot(u) + (self.same_rho - self.diff_rho) * u
+
+        return np.repeat(Ru, self.num_factors) + (1 - self.same_rho) * x
+
+    def quadratic_form(self, x):
+        x = np.ravel(np.asarray(x, dtype=np.float64))
+
+        return np.dot(x, self.dot(x))
+
+    def to_dense(self):
+        num_qualifiers = len(self.CR)
+
+        F = build_concentration_similarity(np.repeat(self.CR, self.num_factors))
+
+        rho = np.ones((num_qualifiers, num_qualifiers)) * self.diff_rho
+        np.fill_diagonal(rho, self.same_rho)
+        rho = np.kron(rho, np.ones((self.num_factors, self.num_factors)))
+
+        Corr = rho * F
+        np.fill_diagonal(Corr, 1)
+
+        return Corr
+
+class TenorCurveCorrelation(object):
+    """IR in-bucket correlation kron(rho, fai) over tenors x sub curves, with an optional inflation factor
+
+    Products with Corr factor into rho * X * fai' on the (tenor x sub curve) matrix X of the factors.
+    rho and fai are read-only copies, so that one instance can serve every bucket of the same shape.
+    """
+
+    def __init__(self, rho, fai, inflation_rho=None):
+        self.rho = np.array(rho, dtype=np.float64)
+        self.fai = np.atleast_2d(np.array(fai, dtype=np.float64))
+        self.inflation_rho = inflation_rho
+        self.__dense = None
+
+        self.rho.setflags(write=False)
+        self.fai.setflags(write=False)
+
+    def stack_key(self):
+        return (self.rho.tobytes(), self.fai.tobytes(), self.inflation_rho)
+
+    def dot(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        stacked = x.ndim == 2
+        x = np.atleast_2d(x)
+
+        num_tenors = self.rho.shape[0]
+        num_curves = self.fai.shape[0]
+        n = num_tenors * num_curves
+
+        X = x[:, :n].reshape(len(x), num_tenors, num_curves)
+        y = np.matmul(np.matmul(self.rho, X), self.fai.T).reshape(len(x), n)
+
+        if self.inflation_rho is not None:
+            x_inflation = x[:, n]
+            y = y + self.inflation_rho * x_inflation[:, np.newaxis]
+            y_inflation = self.inflation_rho * X.sum(axis=(1, 2)) + x_inflation
+            y = np.append(y, y_inflation[:, np.newaxis], axis=1)
+
+        if not stacked:
+            y = y[0]
+
+        return y
+
+    def quadratic_form(self, x):
+        x = np.asarray(x, dtype=np.float64)
+
+        if x.ndim == 2:
+            return np.einsum('ij,ij->i', x, self.dot(x))
 
-        Corr = np.kron(rho, fai)
+        return np.dot(x, self.dot(x))
 
-        pos_inflation = pos_gp[pos_gp.RiskType == 'Risk_Inflation'].copy()
-        if len(pos_inflation) > 0:
-            inflation_rho = np.ones(len(curve)*len(params.IR_Tenor)) * params.IR_Inflation_Rho
+    def to_dense(self):
+        if self.__dense is not None:
+            return self.__dense
+
+        if self.fai.shape == (1, 1):
+            Corr = np.kron(self.rho, self.fai[0][0])
+        else:
+            Corr = np.kron(self.rho, self.fai)
+
+        if self.inflation_rho is not None:
+            inflation_rho = np.ones(len(Corr)) * self.inflation_rho
             inflation_rho_column = np.reshape(inflation_rho, (len(inflation_rho), 1))
             Corr = np.append(Corr, inflation_rho_column, axis=1)
 
             inflation_rho = np.append(inflation_rho, 1)
             inflation_rho = np.reshape(inflation_rho, (1, len(inflation_rho)))
             Corr = np.append(Corr, inflation_rho, axis=0)
-    else:
-        num_qualifiers = pos_gp.Qualifier.nunique()
 
-        F = np.zeros((len(CR), len(CR)))
+        Corr.setflags(write=False)
+        self.__dense = Corr
+
+        return Corr
+
+def build_tenor_curve_correlation(params, margin, curve, inflation):
+    """IR in-bucket correlation of a currency with sub curves curve, with or without inflation"""
+
+    fai = np.zeros((len(curve), len(curve)))
+    fai.fill(params.IR_Fai)
+    np.fill_diagonal(fai, 1)
+
+    if margin == 'Vega' or margin == 'Curvature':
+        fai = 1
+
+    rho = params.IR_Corr
+    if margin == 'Curvature':
+        rho = rho * rho
+
+    inflation_rho = None
+    if inflation:
+        inflation_rho = params.IR_Inflation_Rho
+
+    return TenorCurveCorrelation(rho, fai, inflation_rho)
+
+def build_in_bucket_structure(pos_gp, params, margin, CR):
+    """In-bucket correlation of a bucket in factored form, see build_in_bucket_correlation for the dense matrix"""
+
+    risk_class = pos_gp.RiskClass.unique()[0]
+    if risk_class not in ['IR', 'FX']:
+        bucket = pos_gp.Bucket.unique()[0]
+
+    if risk_class == 'IR':
+        gp_curr = pos_gp.Qualifier.unique()[0]
+        curve = params.IR_Sub_Curve
+        if gp_curr == 'USD':
+            curve = params.IR_USD_Sub_Curve
 
-        for i in range(len(CR)):
-            for j in range(len(CR)):
-                CRi = CR[i]
-                CRj = CR[j]
+        inflation = bool((pos_gp.RiskType == 'Risk_Inflation').any())
 
-                F[i][j] = min(CRi, CRj) / max(CRi, CRj)
+        # The correlation depends only on the sub curves, inflation and margin type
+        key = ('InBucket', risk_class, tuple(curve), inflation, margin, id(params))
+        Corr = Correlation_Cache.get(key, build_tenor_curve_correlation, params, margin, curve, inflation)
+    else:
+        num_factors = 1
 
         if risk_class in ['CreditQ', 'CreditNonQ']:
             if risk_class == 'CreditQ':
@@ -115,14 +368,10 @@ def build_in_bucket_correlation(pos_gp, params, margin, CR):
                     same_is_rho = params.CreditNonQ_Rho_Res_Same_IS
                     diff_is_rho = params.CreditNonQ_Rho_Res_Diff_IS
 
-            rho = np.ones((num_qualifiers, num_qualifiers)) * diff_is_rho
-            np.fill_diagonal(rho, same_is_rho)
-
             if risk_class == 'CreditQ' and margin == 'Delta':
-                one_mat = np.ones((len(tenors) * params.CreditQ_num_sec_type, len(tenors) * params.CreditQ_num_sec_type))
+                num_factors = len(tenors) * params.CreditQ_num_sec_type
             else:
-                one_mat = np.ones((len(tenors), len(tenors)))
-            rho = np.kron(rho, one_mat)
+                num_factors = len(tenors)
 
         elif risk_class in ['Equity', 'Commodity']:
             bucket_df = pd.DataFrame(pos_gp.Bucket.unique(), columns=['bucket'])
@@ -133,38 +382,61 @@ def build_in_bucket_correlation(pos_gp, params, margin, CR):
                 bucket_params = params.Commodity_Rho
 
             rho = pd.merge(bucket_df, bucket_params, left_on=['bucket'], right_on=['bucket'], how='inner')
-            rho = rho['corr'][0]
+            same_is_rho = diff_is_rho = rho['corr'][0]
 
         elif risk_class == 'FX':
-            rho = params.FX_Rho
+            same_is_rho = diff_is_rho = params.FX_Rho
+
+        # CR is repeated for every factor of a qualifier
+        CR = np.ravel(np.asarray(CR, dtype=np.float64))[::num_factors]
 
         if margin == 'Curvature':
-            rho = rho * rho
-            F.fill(1)
+            same_is_rho = same_is_rho * same_is_rho
+            diff_is_rho = diff_is_rho * diff_is_rho
+            CR = np.ones(len(CR))
 
-        Corr = rho * F
-        np.fill_diagonal(Corr, 1)
+        Corr = QualifierBlockCorrelation(same_is_rho, diff_is_rho, CR, num_factors)
 
     return Corr
 
+def build_in_bucket_correlation(pos_gp, params, margin, CR):
+    """Dense in-bucket correlation matrix of a bucket"""
+
+    return build_in_bucket_structure(pos_gp, params, margin, CR).to_dense()
+
 def build_bucket_correlation(pos_delta, params, margin):
+    """Inter-bucket correlation of the bucket margin rows of one CombinationID"""
+
     risk_class = pos_delta.RiskClass.unique()[0]
 
+    # Concentration of every IR currency, one margin row each, curvature rows carry none
+    CR = None
+    if risk_class == 'IR':
+        num_curr = len(pos_delta.Group.unique())
+        if margin == 'Curvature':
+            CR = np.ones(num_curr)
+        else:
+            CR = pos_delta.CR.values[:num_curr]
+
+    return build_group_correlation(risk_class, CR, params, margin)
+
+def build_group_correlation(risk_class, CR, params, margin):
+    """Inter-bucket correlation of a risk class, IR depending on the concentration CR of every currency"""
+
     g = 0
 
     if risk_class == 'IR':
-        all_curr = pos_delta.Group.unique()
-        g = np.ones((len(all_curr), len(all_curr)))
+        if margin == 'Curvature':
+            # Without concentration the correlation depends only on the number of currencies
+            key = ('Bucket', risk_class, margin, len(CR), id(params))
+            g = np.ones((len(CR), len(CR))) * params.IR_Gamma
 
-        if not margin == 'Curvature':
-            for i in range(len(all_curr)):
-                for j in range(len(all_curr)):
-                    CRi = pos_delta.iloc[[i]].CR.values[0]
-                    CRj = pos_delta.iloc[[j]].CR.values[0]
+            return Correlation_Cache.get(key, finish_bucket_correlation, g, margin)
 
-                    g[i][j] = min(CRi, CRj) / max(CRi, CRj)
+        # g[i][j] = min(CRi, CRj) / max(CRi, CRj)
+        g = build_concentration_similarity(CR)
 
-        g = g * params.IR_Gamma
+        return finish_bucket_correlation(g * params.IR_Gamma, margin)
     elif risk_class == 'CreditQ':
         g = params.CreditQ_Corr
     elif risk_class == 'CreditNonQ':
@@ -174,59 +446,175 @@ def build_bucket_correlation(pos_delta, params, margin):
     elif risk_class == 'Commodity':
         g = params.Commodity_Corr
 
+    key = ('Bucket', risk_class, margin, id(params))
+    return Correlation_Cache.get(key, finish_bucket_correlation, g, margin)
+
+def finish_bucket_correlation(g, margin):
+    """Inter-bucket correlation g, squared for curvature, with a zero diagonal"""
+
     if margin == 'Curvature':
         g = pow(g, 2)
 
-    g = np.mat(g)
+    # copy so the parameter tables are never modified in place
+    g = np.array(g, dtype=np.float64)
     np.fill_diagonal(g, 0)
 
     return g
 
+def bucket_labels(risk_class, params):
+    """Bucket of every position in the inter-bucket S vector, None for IR whose S follows the currency rows"""
+
+    labels = None
+    if risk_class == 'CreditQ':
+        labels = params.CreditQ_Bucket[:-1]
+    elif risk_class == 'CreditNonQ':
+        labels = params.CreditNonQ_Bucket[:-1]
+    elif risk_class == 'Equity':
+        labels = params.Equity_Bucket[:-1]
+    elif risk_class == 'Commodity':
+        labels = params.Commodity_Bucket
+
+    return labels
+
+def build_group_index(groups, risk_class, params):
+    """Position in the inter-bucket S vector of every non residual bucket, -1 for unknown buckets"""
+
+    labels = bucket_labels(risk_class, params)
+    if labels is None:
+        return np.arange(len(groups))
+
+    return build_factor_index(groups, labels)
+
+def build_bucket_index(pos_gp, params):
+    """Position in the inter-bucket S vector of every non residual bucket row"""
+
+    risk_class = pos_gp.RiskClass.unique()[0]
+
+    return build_group_index(pos_gp.Group.values, risk_class, params)
+
+def scatter_bucket_S(S, idx, risk_class, params):
+    """Inter-bucket S vector from the S of every non residual bucket and its position idx
+
+    Unknown buckets are left out and the first bucket at a position wins.
+    """
+
+    S = np.asarray(S, dtype=np.float64)
+
+    labels = bucket_labels(risk_class, params)
+    if labels is None:
+        return S
+
+    S_vector = np.zeros(len(labels))
+
+    positions, first = np.unique(idx, return_index=True)
+    is_known = positions >= 0
+    S_vector[positions[is_known]] = S[first[is_known]]
+
+    return S_vector
+
 def build_non_residual_S(pos_gp, params):
+    """Inter-bucket S vector of the non residual bucket rows of one CombinationID"""
+
     risk_class = pos_gp.RiskClass.unique()[0]
-    # pos_gp has all 0 index, so has to reset for loop works
-    pos_gp.reset_index(inplace=True)
 
-    if risk_class == 'IR':
-        S = pos_gp.S
-    elif risk_class in ['CreditQ', 'CreditNonQ', 'Equity', 'Commodity']:
-        if risk_class == 'CreditQ':
-            S = np.zeros(len(params.CreditQ_Bucket) - 1)
+    if risk_class == 'FX':
+        return 0
+
+    return scatter_bucket_S(pos_gp.S.values, build_bucket_index(pos_gp, params), risk_class, params)
+
+class BucketState(object):
+    """Netted positions, WS, CR, in-bucket correlation, K and margin row of one bucket of one CombinationID
+
+    S, the bucket concentration and the curvature sums of the margin row are kept as scalars, so that
+    buckets aggregate into their risk class margin on plain arrays.
+    """
+
+    def __init__(self, case, group, pos, WS, CR, Corr):
+        self.case = case
+        self.group = group
+        self.pos = pos
+        self.WS = WS
+        self.CR = CR
+        self.Corr = Corr
+        self.K = None
+        self.margin = None
+        self.S = None
+        self.bucket_CR = None
+        self.CVR_sum = None
+        self.CVR_abs_sum = None
+
+    def set_margin(self, margin):
+        self.margin = margin
+        self.S = margin.S.values[0]
+
+        # Curvature margin rows carry no concentration
+        self.bucket_CR = 1.0
+        if 'CR' in margin.columns:
+            self.bucket_CR = margin.CR.values[0]
+
+        if 'CVR_sum' in margin.columns:
+            self.CVR_sum = margin.CVR_sum.values[0]
+            self.CVR_abs_sum = margin.CVR_abs_sum.values[0]
+
+class QuadraticFormKernel(object):
+    """x * C * x' for a dense symmetric C, computing C * x into a preallocated scratch buffer"""
+
+    def __init__(self):
+        self.__scratch = np.empty(0)
+
+    def scratch(self, n):
+        """First n elements of the scratch buffer, grown to the largest n seen"""
 
-            for i in range(len(params.CreditQ_Bucket) - 1):
-                for j in range(len(pos_gp.Group)):
-                    if pos_gp.Group[j] == params.CreditQ_Bucket[i]:
-                        S[i] = pos_gp.S[j]
-                        break
+        if n > len(self.__scratch):
+            self.__scratch = np.empty(n)
 
-        elif risk_class == 'CreditNonQ':
-            S = np.zeros(len(params.CreditNonQ_Bucket) - 1)
+        return self.__scratch[:n]
 
-            for i in range(len(params.CreditNonQ_Bucket) - 1):
-                for j in range(len(pos_gp.Group)):
-                    if pos_gp.Group[j] == params.CreditNonQ_Bucket[i]:
-                        S[i] = pos_gp.S[j]
-                        break
+    def __call__(self, x, C):
+        if hasattr(C, 'quadratic_form'):
+            return C.quadratic_form(x)
 
-        elif risk_class == 'Equity':
-            S = np.zeros(len(params.Equity_Bucket) - 1)
+        x = np.ravel(np.asarray(x, dtype=np.float64))
+        C = np.asarray(C, dtype=np.float64)
 
-            for i in range(len(params.Equity_Bucket) - 1):
-                for j in range(len(pos_gp.Group)):
-                    if pos_gp.Group[j] == params.Equity_Bucket[i]:
-                        S[i] = pos_gp.S[j]
-                        break
+        Cx = self.scratch(len(x))
+        np.dot(C, x, out=Cx)
 
-        elif risk_class == 'Commodity':
-            S = np.zeros(len(params.Commodity_Bucket))
+        return np.dot(x, Cx)
 
-            for i in range(len(params.Commodity_Bucket)):
-                for j in range(len(pos_gp.Group)):
-                    if pos_gp.Group[j] == params.Commodity_Bucket[i]:
-                        S[i] = pos_gp.S[j]
-                        break
+quadratic_form = QuadraticFormKernel()
 
-    elif risk_class == 'FX':
-        S = 0
+def batch_quadratic_form(X, C):
+    """Evaluate x * C * x' for a list of vectors
+
+    Vectors sharing the same correlation, or factored correlations with equal stack keys, are
+    stacked into one matrix product; the others go through the quadratic_form kernel one by one.
+    """
+
+    values = np.zeros(len(X))
+
+    shapes = {}
+    for i in range(len(X)):
+        if hasattr(C[i], 'quadratic_form'):
+            stack_key = C[i].stack_key()
+        else:
+            stack_key = id(C[i])
+
+        if stack_key is None:
+            values[i] = quadratic_form(X[i], C[i])
+        else:
+            shapes.setdefault((np.size(X[i]), stack_key), []).append(i)
+
+    for (n, stack_key), idx in shapes.items():
+        if len(idx) == 1:
+            values[idx[0]] = quadratic_form(X[idx[0]], C[idx[0]])
+            continue
+
+        W = np.vstack([np.ravel(np.asarray(X[i], dtype=np.float64)) for i in idx])
+
+        if hasattr(C[idx[0]], 'quadratic_form'):
+            values[idx] = C[idx[0]].quadratic_form(W)
+        else:
+            values[idx] = np.einsum('ij,ij->i', np.dot(W, np.asarray(C[idx[0]], dtype=np.float64)), W)
 
-    return S
\ No newline at end of file
+    return values
@@ -1,6 +1,158 @@
+import numpy as np
 import pandas as pd
+import os
+import shutil
+import hashlib
+import pickle
+import logging
 
-configs = pd.ExcelFile('simm_config.xlsx')
+##############################
+# Setup Logging Configuration
+##############################
+logger = logging.getLogger(os.path.basename(__file__))
+if not len(logger.handlers):
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s|%(name)s === %(message)s ===', datefmt='%Y-%m-%d %I:%M:%S')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    file_handler = logging.FileHandler('log.txt')
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(logging.DEBUG)
+    logger.addHandler(file_handler)
+###############################
+
+Config_File = 'simm_config.xlsx'
+Config_Cache_Path = 'simm_config.cache'
+
+# Calibration tables loaded on first access: name -> (sheet, converters, as numpy matrix)
+Config_Tables = {
+    'Risk_Class_Corr': ('Risk_class_correlation', None, True),
+    'IR_CR_Thrd': ('IR_CR_THR', None, False),
+    'IR_Weights': ('IR_weights', {'curr': str}, False),
+    'IR_Corr': ('IR_correlation', None, True),
+    'CreditQ_Weights': ('CreditQ_weights', {'bucket': str}, False),
+    'CreditQ_Corr': ('CreditQ_correlation', None, True),
+    'CreditQ_CR_Thrd': ('CreditQ_CR_THR', None, False),
+    'CreditNonQ_Weights': ('CreditNonQ_weights', {'bucket': str}, False),
+    'CreditNonQ_Corr': ('CreditNonQ_correlation', None, True),
+    'CreditNonQ_CR_Thrd': ('CreditNonQ_CR_THR', None, False),
+    'Equity_Weights': ('Equity_weights', {'bucket': str}, False),
+    'Equity_Rho': ('Equity_in_bucket_correlation', {'bucket': str}, False),
+    'Equity_Corr': ('Equity_correlation', None, True),
+    'Equity_CR_Thrd': ('Equity_CR_THR', None, False),
+    'Commodity_Weights': ('Commodity_weights', {'bucket': str}, False),
+    'Commodity_Rho': ('Commodity_in_bucket_correlation', {'bucket': str}, False),
+    'Commodity_Corr': ('Commodity_correlation', None, True),
+    'Commodity_CR_Thrd': ('Commodity_CR_THR', None, False),
+    'FX_CR_Thrd': ('FX_CR_THR', None, False),
+}
+
+class ParameterSet(object):
+    """Calibration tables of a config workbook, parsed lazily and memoized
+
+    Parsed sheets are kept in a compiled cache directory keyed by a hash of
+    the workbook, so later processes load a table in milliseconds and the
+    cache is rebuilt sheet by sheet when the workbook changes.
+    """
+
+    def __init__(self, config_file=Config_File, cache_path=Config_Cache_Path):
+        # Absolute paths, as worker processes load tables from their own working directories
+        self.__config_file = os.path.abspath(config_file)
+        self.__cache_path = os.path.abspath(cache_path)
+        self.__source_hash = None
+        self.__excl_file = None
+        self.__tables = {}
+
+    def source_hash(self):
+        """Hash of the config workbook, the table layout parsed from it and the versions pickling the tables"""
+
+        if self.__source_hash is None:
+            sha = hashlib.sha1()
+            with open(self.__config_file, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+            sha.update(repr(sorted(Config_Tables.items())).encode('utf-8'))
+
+            # Tables pickled under other pandas or numpy versions may not load
+            sha.update('pandas {0} numpy {1}'.format(pd.__version__, np.__version__).encode('utf-8'))
+
+            self.__source_hash = sha.hexdigest()
+
+        return self.__source_hash
+
+    def cache_file(self, sheet):
+        return os.path.join(self.__cache_path, self.source_hash(), '{0}.pkl'.format(sheet))
+
+    def parse_sheet(self, sheet, converters):
+        """Parse one sheet of the workbook and store it in the compiled cache"""
+
+        if self.__excl_file is None:
+            self.__excl_file = pd.ExcelFile(self.__config_file)
+
+        table = self.__excl_file.parse(sheet, converters=converters)
+
+        cache_path = os.path.dirname(self.cache_file(sheet))
+        if not os.path.isdir(cache_path):
+            # Drop tables compiled from previous versions of the workbook
+            if os.path.isdir(self.__cache_path):
+                for source_hash in os.listdir(self.__cache_path):
+                    if source_hash != self.source_hash():
+                        shutil.rmtree(os.path.join(self.__cache_path, source_hash), ignore_errors=True)
+
+            # Worker processes may compile sheets of the same workbook at the same time
+            os.makedirs(cache_path, exist_ok=True)
+
+        tmp_file = '{0}.{1}.tmp'.format(self.cache_file(sheet), os.getpid())
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.cache_file(sheet))
+
+        return table
+
+    def load_sheet(self, sheet, converters):
+        """Load one sheet from the compiled cache, parsing the workbook on a miss"""
+
+        if os.path.isfile(self.cache_file(sheet)):
+            try:
+                with open(self.cache_file(sheet), 'rb') as f:
+                    return pickle.load(f)
+            except (pickle.UnpicklingError, EOFError, OSError) as e:
+                logger.warning('Recompile unreadable config cache {0}: {1}'.format(self.cache_file(sheet), e))
+
+        return self.parse_sheet(sheet, converters)
+
+    def table(self, name):
+        if name not in self.__tables:
+            sheet, converters, as_matrix = Config_Tables[name]
+
+            table = self.load_sheet(sheet, converters)
+            if as_matrix:
+                table = table.values.astype(np.float64)
+
+            self.__tables[name] = table
+
+        return self.__tables[name]
+
+    def __getattr__(self, name):
+        if name in Config_Tables:
+            return self.table(name)
+
+        raise AttributeError(name)
+
+Parameters = ParameterSet()
+
+def __getattr__(name):
+    """Resolve calibration tables of the module from the default parameter set"""
+
+    if name in Config_Tables:
+        table = Parameters.table(name)
+        globals()[name] = table
+        return table
+
+    raise AttributeError("module '{0}' has no attribute '{1}'".format(__name__, name))
 
 Product = ['RatesFX', 'Credit', 'Equity', 'Commodity']
 
@@ -18,8 +170,6 @@ Vega_Factor = ['Risk_IRVol', 'Risk_CreditVol', 'Risk_CreditVolNonQ', 'Risk_Equit
 Curvature_Factor = Vega_Factor
 #Curvature_Factor = ['Risk_IRCV', 'Risk_CreditCV', 'Risk_EquityCV', 'Risk_FXCV', 'Risk_CommodityCV']
 
-Risk_Class_Corr = configs.parse('Risk_class_correlation')
-
 IR_Bucket = ['1', '2', '3']
 IR_Tenor = ['2w', '1m', '3m', '6m', '1y', '2y', '3y', '5y', '10y', '15y', '20y', '30y']
 IR_Sub_Curve = ['OIS', 'Libor1m', 'Libor3m', 'Libor6m', 'Libor12m']
@@ -27,9 +177,6 @@ IR_USD_Sub_Curve = IR_Sub_Curve + ['Prime']
 IR_Reg_Vol_Well_Traded_Curr = ['USD', 'EUR', 'GBP']
 IR_Reg_Vol_Less_Well_Traded_Curr = ['CHF', 'AUD', 'NZD', 'CAD', 'SEK', 'NOK', 'DKK', 'HKD', 'KRW', 'SGD', 'TWD']
 IR_Low_Vol_Curr = ['JPY']
-IR_CR_Thrd = configs.parse('IR_CR_THR')
-IR_Weights = configs.parse('IR_weights', converters={'curr': str})
-IR_Corr = configs.parse('IR_correlation')
 IR_Fai = 0.982
 IR_Gamma = 0.27
 IR_Inflation_Weights = 32
@@ -42,13 +189,10 @@ CreditQ_Tenor = ['1y', '2y', '3y', '5y', '10y']
 CreditQ_CR_Sov_incl_Central_Banks = ['1', '7']
 CreditQ_CR_Corp_Entities = ['2', '3', '4', '5', '6', '8', '9', '10', '11', '12']
 CreditQ_CR_Not_Classified = ['Residual']
-CreditQ_Weights = configs.parse('CreditQ_weights', converters={'bucket': str})
 CreditQ_Rho_Agg_Same_IS = 0.98
 CreditQ_Rho_Agg_Diff_IS = 0.55
 CreditQ_Rho_Res_Same_IS = 0.5
 CreditQ_Rho_Res_Diff_IS = 0.5
-CreditQ_Corr = configs.parse('CreditQ_correlation')
-CreditQ_CR_Thrd = configs.parse('CreditQ_CR_THR')
 CreditQ_VRW = 0.35
 CreditQ_num_sec_type = 2
 
@@ -57,13 +201,10 @@ CreditNonQ_Tenor = ['1y', '2y', '3y', '5y', '10y']
 CreditNonQ_CR_IG = ['1']
 CreditNonQ_CR_HY_Non_Rated = ['2']
 CreditNonQ_CR_Not_Classified = ['Residual']
-CreditNonQ_Weights = configs.parse('CreditNonQ_weights', converters={'bucket': str})
 CreditNonQ_Rho_Agg_Same_IS = 0.6
 CreditNonQ_Rho_Agg_Diff_IS = 0.21
 CreditNonQ_Rho_Res_Same_IS = 0.5
 CreditNonQ_Rho_Res_Diff_IS = 0.5
-CreditNonQ_Corr = configs.parse('CreditNonQ_correlation')
-CreditNonQ_CR_Thrd = configs.parse('CreditNonQ_CR_THR')
 CreditNonQ_VRW = 0.35
 
 Equity_Tenor = ['2w', '1m', '3m', '6m', '1y', '2y', '3y', '5y', '10y', '15y', '20y', '30y']
@@ -74,10 +215,6 @@ Equity_CR_Emerging_Small_Cap = ['9']
 Equity_CR_Developed_Small_Cap = ['10']
 Equity_CR_Index_Funds_ETF = ['11']
 Equity_CR_Not_Classified = ['Residual']
-Equity_Weights = configs.parse('Equity_weights', converters={'bucket': str})
-Equity_Rho = configs.parse('Equity_in_bucket_correlation', converters={'bucket': str})
-Equity_Corr = configs.parse('Equity_correlation')
-Equity_CR_Thrd = configs.parse('Equity_CR_THR')
 Equity_VRW = 0.21
 
 Commodity_Tenor = ['2w', '1m', '3m', '6m', '1y', '2y', '3y', '5y', '10y', '15y', '20y', '30y']
@@ -98,10 +235,6 @@ Commodity_CR_Grains = ['13']
 Commodity_CR_Softs = ['14']
 Commodity_CR_Livestock = ['15']
 Commodity_CR_Others = ['16']
-Commodity_Weights = configs.parse('Commodity_weights', converters={'bucket': str})
-Commodity_Rho = configs.parse('Commodity_in_bucket_correlation', converters={'bucket': str})
-Commodity_Corr = configs.parse('Commodity_correlation')
-Commodity_CR_Thrd = configs.parse('Commodity_CR_THR')
 Commodity_VRW = 0.36
 
 FX_Tenor = ['2w', '1m', '3m', '6m', '1y', '2y', '3y', '5y', '10y', '15y', '20y', '30y']
@@ -110,5 +243,13 @@ FX_Rho = 0.5
 FX_VRW = 0.21
 FX_Significantly_Material = ['USD', 'EUR', 'JPY', 'GBP', 'AUD', 'CHF', 'CAD']
 FX_Frequently_Traded = ['BRL', 'CNY', 'HKD', 'INR', 'KRW', 'MXN', 'NOK', 'NZD', 'RUB', 'SEK', 'SGD', 'TRY', 'ZAR']
-FX_CR_Thrd = configs.parse('FX_CR_THR')
 
+# Fixed categories of the label columns of position frames, extended by any other values found in the input
+Label_Categories = {
+    'ProductClass': Product,
+    'RiskClass': RiskType,
+    'RiskType': IR + CreditQ + CreditNonQ + Equity + FX + Commodity,
+    'Bucket': IR_Bucket + CreditQ_Bucket + CreditNonQ_Bucket + Equity_Bucket + Commodity_Bucket,
+    'Label1': IR_Tenor + CreditQ_Tenor + CreditNonQ_Tenor + Equity_Tenor + Commodity_Tenor + FX_Tenor,
+    'Label2': IR_USD_Sub_Curve + ['Non_Sec', 'Sec'],
+}
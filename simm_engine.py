@@ -0,0 +1,433 @@
+import numpy as np
+import pandas as pd
+import os
+import logging
+import delta_margin
+import vega_margin
+import curvature_margin
+import simm_lib
+
+##############################
+# Setup Logging Configuration
+##############################
+logger = logging.getLogger(os.path.basename(__file__))
+if not len(logger.handlers):
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s|%(name)s === %(message)s ===', datefmt='%Y-%m-%d %I:%M:%S')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    file_handler = logging.FileHandler('log.txt')
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(logging.DEBUG)
+    logger.addHandler(file_handler)
+###############################
+
+class IncrementalSIMM(object):
+    """SIMM of run cases kept up to date bucket by bucket as sensitivities change
+
+    Bucket states are cached by (CombinationID, ProductClass, RiskClass, MarginType, Group) and risk
+    class margins by (CombinationID, ProductClass, RiskClass, MarginType). An update recomputes only
+    the buckets holding changed SensitivityIDs and re-aggregates the risk classes they belong to.
+    """
+
+    def __init__(self, pos, params):
+        self.params = params
+        self.margin_loaders = {'Delta': delta_margin.DeltaMargin(),
+                               'Vega': vega_margin.VegaMargin(),
+                               'Curvature': curvature_margin.CurvatureMargin()}
+        self.margin_factors = {'Delta': params.Delta_Factor,
+                               'Vega': params.Vega_Factor,
+                               'Curvature': params.Curvature_Factor}
+
+        self.pos = pos.reset_index(drop=True)
+        self.next_row = len(self.pos)
+
+        self.bucket_rows = self.index_buckets(self.pos)
+        self.buckets = {}
+        self.risk_class_groups = {}
+        self.risk_class_margins = {}
+
+        self.recalculate(set(self.bucket_rows))
+
+    def index_buckets(self, pos):
+        """Row labels of pos per bucket key (CombinationID, ProductClass, RiskClass, MarginType, Group)"""
+
+        bucket_rows = {}
+
+        for margin_type in ['Delta', 'Vega', 'Curvature']:
+            pos_margin = pos[pos.RiskType.isin(self.margin_factors[margin_type])]
+            if len(pos_margin) == 0:
+                continue
+
+            group = np.where(pos_margin.RiskClass == 'IR', pos_margin.Qualifier,
+                             np.where(pos_margin.RiskClass == 'FX', pos_margin.RiskType, pos_margin.Bucket))
+            group = pd.Series(group, index=pos_margin.index)
+
+            gps = pos_margin.groupby([pos_margin.CombinationID, pos_margin.ProductClass, pos_margin.RiskClass, group], sort=False, observed=True)
+            for (case, product, risk_class, gp), rows in gps.groups.items():
+                bucket_rows[(case, product, risk_class, margin_type, gp)] = np.asarray(rows)
+
+        return bucket_rows
+
+    def recalculate(self, bucket_keys):
+        """Rebuild the given bucket states and re-aggregate the risk class margins they belong to"""
+
+        margin_keys = {}
+        for key in bucket_keys:
+            margin_keys.setdefault(key[1:4], []).append(key)
+
+            risk_class_key = key[:4]
+            if risk_class_key in self.risk_class_groups:
+                self.risk_class_groups[risk_class_key].discard(key[4])
+            self.buckets.pop(key, None)
+
+        risk_class_keys = set(key[:4] for key in bucket_keys)
+
+        for (product, risk_class, margin_type), keys in margin_keys.items():
+            keys = [key for key in keys if key in self.bucket_rows]
+            if len(keys) == 0:
+                continue
+
+            logger.info('Recalculate {0} {1} buckets of {2} {3}'.format(len(keys), margin_type, product, risk_class))
+
+            margin_loader = self.margin_loaders[margin_type]
+            rows = np.concatenate([self.bucket_rows[key] for key in keys])
+            pos_delta = simm_lib.prepare_risk_factors(self.pos.loc[rows], self.params, margin_loader)
+
+            for state in simm_lib.build_bucket_states(pos_delta, self.params, margin_loader):
+                risk_class_key = (state.case, product, risk_class, margin_type)
+                self.buckets[risk_class_key + (state.group,)] = state
+                self.risk_class_groups.setdefault(risk_class_key, set()).add(state.group)
+
+        self.aggregate(risk_class_keys)
+
+    def aggregate(self, risk_class_keys):
+        """Recompute the risk class margins of the given (CombinationID, ProductClass, RiskClass, MarginType) keys"""
+
+        margin_keys = {}
+        for key in risk_class_keys:
+            if len(self.risk_class_groups.get(key, [])) == 0:
+                self.risk_class_groups.pop(key, None)
+                self.risk_class_margins.pop(key, None)
+            else:
+                margin_keys.setdefault(key[1:], []).append(key)
+
+        for (product, risk_class, margin_type), keys in margin_keys.items():
+            case_states = []
+            for key in keys:
+                groups = simm_lib.sort_risk_groups(self.risk_class_groups[key], risk_class)
+                case_states.append([self.buckets[key + (gp,)] for gp in groups])
+
+            margins = simm_lib.aggregate_bucket_states(case_states, self.params, margin_type)
+
+            for key, margin in zip(keys, margins):
+                self.risk_class_margins[key] = margin
+
+    def update(self, changed=None, removed=None):
+        """Replace the rows of changed SensitivityIDs, drop removed ones and return the new SIMM
+
+        Both frames are matched on (CombinationID, SensitivityID); changed rows carry the full
+        run case columns and are added after the old rows of the same SensitivityID are dropped.
+        """
+
+        updates = [pos for pos in [changed, removed] if pos is not None and len(pos) > 0]
+        if len(updates) == 0:
+            return self.simm()
+
+        ids = pd.concat([pos[['CombinationID', 'SensitivityID']] for pos in updates])
+        ids = pd.MultiIndex.from_arrays([ids.CombinationID.values, ids.SensitivityID.values])
+
+        is_old = pd.MultiIndex.from_arrays([self.pos.CombinationID.values, self.pos.SensitivityID.values]).isin(ids)
+        old_rows = self.index_buckets(self.pos[is_old])
+
+        pos = [self.pos[~is_old]]
+        new_rows = {}
+        if changed is not None and len(changed) > 0:
+            changed = changed.copy()
+            changed.index = np.arange(self.next_row, self.next_row + len(changed))
+            self.next_row = self.next_row + len(changed)
+
+            new_rows = self.index_buckets(changed)
+            pos.append(changed)
+
+        self.pos = pd.concat(pos)
+
+        for key, rows in old_rows.items():
+            self.bucket_rows[key] = np.setdiff1d(self.bucket_rows[key], rows)
+        for key, rows in new_rows.items():
+            self.bucket_rows[key] = np.concatenate([self.bucket_rows.get(key, rows[:0]), rows])
+
+        bucket_keys = set(old_rows) | set(new_rows)
+        for key in bucket_keys:
+            if len(self.bucket_rows[key]) == 0:
+                del self.bucket_rows[key]
+
+        logger.info('Update {0} sensitivities touching {1} buckets'.format(len(ids), len(bucket_keys)))
+
+        self.recalculate(bucket_keys)
+
+        return self.simm()
+
+    def risk_class_margin_gradient(self):
+        """dSIMM / dM of every cached risk class margin, M summing to the risk class entry of the product margin"""
+
+        risk_class_corr = np.asarray(self.params.Risk_Class_Corr)
+        risk_class_idx = dict((risk_class, i) for i, risk_class in enumerate(self.params.RiskType))
+
+        product_margins = {}
+        for key, margin in self.risk_class_margins.items():
+            m = product_margins.setdefault(key[:2], np.zeros(len(risk_class_idx)))
+            m[risk_class_idx[key[2]]] += margin
+
+        product_gradients = {}
+        for key, m in product_margins.items():
+            Cm = np.dot(risk_class_corr, m)
+            product_margin = np.sqrt(np.dot(m, Cm))
+            product_gradients[key] = Cm / product_margin if product_margin > 0 else Cm * 0
+
+        return dict((key, product_gradients[key[:2]][risk_class_idx[key[2]]]) for key in self.risk_class_margins)
+
+    def bucket_gradient(self, state, dK, dS, dCVR_sum, dCVR_abs_sum):
+        """dM / dWS of one bucket from the partial derivatives of M to its K, S, CVR_sum and CVR_abs_sum"""
+
+        WS = np.ravel(np.asarray(state.WS, dtype=np.float64))
+
+        dK_dWS = np.zeros(len(WS))
+        if state.K > 0:
+            dK_dWS = np.ravel(state.Corr.dot(WS)) / state.K
+
+        WS_sum = WS.sum()
+        if WS_sum >= state.K:
+            dS_dWS = dK_dWS
+        elif WS_sum <= -state.K:
+            dS_dWS = -dK_dWS
+        else:
+            dS_dWS = np.ones(len(WS))
+
+        return dK * dK_dWS + dS * dS_dWS + dCVR_sum + dCVR_abs_sum * np.sign(WS)
+
+    def allocate(self):
+        """Euler allocation of the SIMM of every CombinationID to its SensitivityIDs
+
+        Partial derivatives run from the product margin through the risk class margin, including the
+        curvature lambda and theta terms, to bucket K and S and on to WS = RW * s * CR. Concentration
+        factors and the correlations depending on them are held at their portfolio level, which keeps
+        SIMM homogeneous of degree one in the sensitivities so the allocations sum to the total SIMM.
+        """
+
+        margin_gradient = self.risk_class_margin_gradient()
+
+        margin_keys = {}
+        for key in self.risk_class_margins:
+            margin_keys.setdefault(key[1:], []).append(key)
+
+        margin_rows = {}
+        for key, rows in self.bucket_rows.items():
+            margin_rows.setdefault(key[1:4], []).append(rows)
+
+        allocation_all = []
+        for (product, risk_class, margin_type), keys in margin_keys.items():
+            logger.info('Allocate {0} {1} {2} margin'.format(product, risk_class, margin_type))
+
+            margin_loader = self.margin_loaders[margin_type]
+
+            # Gradient of SIMM to the netted sensitivity of every bucket row
+            pos_gradient = []
+            for key in keys:
+                groups = simm_lib.sort_risk_groups(self.risk_class_groups[key], risk_class)
+                states = [self.buckets[key + (gp,)] for gp in groups]
+
+                pos_delta = pd.concat([state.margin for state in states])
+                gradients = simm_lib.calculate_risk_class_margin_gradient(pos_delta, self.params, margin_type)
+
+                for i, state in enumerate(states):
+                    dWS = self.bucket_gradient(state, *[gradient[i] for gradient in gradients])
+                    dWS = dWS * margin_gradient[key] * margin_loader.build_risk_factor_scale(state.pos, self.params, state.CR)
+
+                    idx, num_factors = margin_loader.build_risk_factor_index(state.pos, self.params)
+
+                    pos_state = state.pos.copy()
+                    pos_state['Gradient'] = np.where(idx >= 0, dWS[np.maximum(idx, 0)], 0)
+                    pos_gradient.append(pos_state)
+
+            pos_gradient = pd.concat(pos_gradient)
+
+            # Net every run case row on its own, keyed by row label, and match it to its netted sensitivity
+            pos = self.pos.loc[np.concatenate(margin_rows[(product, risk_class, margin_type)])]
+
+            pos_row = pos.copy()
+            pos_row['CombinationID'] = pos_row.index.values
+            if margin_type == 'Curvature':
+                pos_row = margin_loader.input_scaling(pos_row)
+            pos_row = margin_loader.net_sensitivities(pos_row, self.params)
+
+            pos_row['Row'] = pos_row['CombinationID']
+            pos_row['CombinationID'] = pos.CombinationID.loc[pos_row.Row].values
+
+            factor_group = [column for column in pos_row.columns if column not in ['AmountUSD', 'Row']]
+            pos_row = pd.merge(pos_row, pos_gradient[factor_group + ['Gradient']], how='left')
+
+            allocation = pd.DataFrame({'CombinationID': pos_row.CombinationID.values,
+                                       'SensitivityID': pos.SensitivityID.loc[pos_row.Row].values,
+                                       'ProductClass': product, 'RiskClass': risk_class, 'MarginType': margin_type,
+                                       'Allocation': pos_row.AmountUSD.values * pos_row.Gradient.fillna(0).values},
+                                      columns=['CombinationID', 'SensitivityID', 'ProductClass', 'RiskClass',
+                                               'MarginType', 'Allocation'])
+            allocation_all.append(allocation)
+
+        allocation_all = pd.concat(allocation_all)
+        allocation_all = allocation_all.groupby(['CombinationID', 'SensitivityID', 'ProductClass', 'RiskClass', 'MarginType'],
+                                                sort=False, observed=True).agg({'Allocation': np.sum})
+        allocation_all.reset_index(inplace=True)
+
+        return allocation_all
+
+    def simm(self):
+        """SIMM of every CombinationID from the cached risk class margins"""
+
+        product_margin = pd.DataFrame([key + (margin,) for key, margin in self.risk_class_margins.items()],
+                                      columns=['CombinationID', 'ProductClass', 'RiskClass', 'MarginType', 'Margin'])
+
+        return simm_lib.aggregate_product_margin(product_margin, self.params)
+
+class WhatIfSIMM(IncrementalSIMM):
+    """Incremental SIMM of candidate add-ons and removals priced against a base portfolio
+
+    Every candidate only rebuilds the buckets it touches, reusing the cached states of all other
+    buckets; the touched buckets of all candidates are evaluated together in one batched pass.
+    """
+
+    def candidate_buckets(self, case, additions, removals):
+        """Row labels per candidate bucket key: base rows left after removals plus added rows"""
+
+        base_rows = {}
+        added_rows = {}
+
+        if removals is not None and len(removals) > 0:
+            base = self.pos[self.pos.CombinationID == case].drop('CombinationID', axis=1)
+            base['Row'] = base.index
+            removed = pd.merge(removals[['Candidate', 'SensitivityID']], base)
+            removed = removed.rename(columns={'Candidate': 'CombinationID'}).set_index('Row')
+
+            for key, rows in self.index_buckets(removed).items():
+                base_key = (case,) + key[1:]
+                base_rows[key] = np.setdiff1d(self.bucket_rows[base_key], rows)
+
+        if additions is not None and len(additions) > 0:
+            for key, rows in self.index_buckets(additions).items():
+                added_rows[key] = rows
+                base_key = (case,) + key[1:]
+                if key not in base_rows:
+                    base_rows[key] = self.bucket_rows.get(base_key, rows[:0])
+
+        return base_rows, added_rows
+
+    def price(self, case, additions=None, removals=None):
+        """SIMM of portfolio case with each candidate applied, and its increment over the base SIMM
+
+        additions carry the run case columns of the added sensitivities with a Candidate column;
+        removals list the (Candidate, SensitivityID) pairs taken out of the base portfolio.
+        """
+
+        if additions is not None:
+            additions = additions.copy()
+            additions['CombinationID'] = additions['Candidate']
+            additions.index = np.arange(self.next_row, self.next_row + len(additions))
+
+        base_rows, added_rows = self.candidate_buckets(case, additions, removals)
+
+        # Rows of the touched buckets of all candidates, labelled by candidate
+        margin_keys = {}
+        for key in base_rows:
+            margin_keys.setdefault(key[1:4], []).append(key)
+
+        buckets = {}
+        for (product, risk_class, margin_type), keys in margin_keys.items():
+            logger.info('Price {0} {1} buckets of {2} {3}'.format(len(keys), margin_type, product, risk_class))
+
+            pos_candidate = []
+            for key in keys:
+                pos_base = self.pos.loc[base_rows[key]].copy()
+                pos_base['CombinationID'] = key[0]
+                pos_candidate.append(pos_base)
+
+                if key in added_rows:
+                    pos_candidate.append(additions.loc[added_rows[key]])
+
+            pos_candidate = pd.concat(pos_candidate)
+            if len(pos_candidate) == 0:
+                continue
+
+            margin_loader = self.margin_loaders[margin_type]
+            pos_delta = simm_lib.prepare_risk_factors(pos_candidate, self.params, margin_loader)
+
+            for state in simm_lib.build_bucket_states(pos_delta, self.params, margin_loader):
+                buckets[(state.case, product, risk_class, margin_type, state.group)] = state
+
+        # Risk class margins of the candidates: touched buckets replace the base buckets
+        risk_class_keys = {}
+        for key in base_rows:
+            risk_class_keys.setdefault(key[:4], set()).add(key[4])
+
+        margin_keys = {}
+        for key, touched in risk_class_keys.items():
+            base_key = (case,) + key[1:]
+            groups = set(self.risk_class_groups.get(base_key, [])) - touched
+            groups.update(gp for gp in touched if key + (gp,) in buckets)
+
+            case_states = []
+            for gp in simm_lib.sort_risk_groups(groups, key[2]):
+                if key + (gp,) in buckets:
+                    case_states.append(buckets[key + (gp,)])
+                else:
+                    case_states.append(self.buckets[base_key + (gp,)])
+
+            margin_keys.setdefault(key[1:], []).append((key, case_states))
+
+        candidate_margins = {}
+        for (product, risk_class, margin_type), key_states in margin_keys.items():
+            # None marks a risk class left without buckets by the candidate
+            for key, states in key_states:
+                candidate_margins[key] = None
+
+            key_states = [(key, states) for key, states in key_states if len(states) > 0]
+            if len(key_states) > 0:
+                margins = simm_lib.aggregate_bucket_states([states for key, states in key_states], self.params,
+                                                           margin_type)
+                for (key, states), margin in zip(key_states, margins):
+                    candidate_margins[key] = margin
+
+        # Candidate risk class margins fall back to the base margins of untouched risk classes
+        candidates = []
+        for pos in [additions, removals]:
+            if pos is not None:
+                candidates.extend(pos.Candidate.unique())
+        candidates = list(pd.unique(np.asarray(candidates, dtype=object)))
+
+        base_margins = [(key[1:], margin) for key, margin in self.risk_class_margins.items() if key[0] == case]
+
+        product_margin = [(case,) + key + (margin,) for key, margin in base_margins]
+        for candidate in candidates:
+            for key, margin in base_margins:
+                if (candidate,) + key not in candidate_margins:
+                    product_margin.append((candidate,) + key + (margin,))
+
+        for key, margin in candidate_margins.items():
+            if margin is not None:
+                product_margin.append(key + (margin,))
+
+        product_margin = pd.DataFrame(product_margin,
+                                      columns=['CombinationID', 'ProductClass', 'RiskClass', 'MarginType', 'Margin'])
+
+        simm = simm_lib.aggregate_product_margin(product_margin, self.params)
+        simm = simm.set_index('CombinationID').SIMM_Benchmark
+        simm_base = simm.get(case, 0)
+
+        ret = pd.DataFrame({'Candidate': candidates}, columns=['Candidate', 'SIMM_Benchmark', 'Incremental'])
+        ret['SIMM_Benchmark'] = simm.reindex(candidates).fillna(0).values
+        ret['Incremental'] = ret['SIMM_Benchmark'] - simm_base
+
+        return ret
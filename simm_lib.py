@@ -5,6 +5,8 @@ import logging
 import math
 import shutil
 import re
+import queue
+import threading
 import delta_margin
 import vega_margin
 import curvature_margin
@@ -33,7 +35,7 @@ def prep_output_directory(params):
     """Setup output directory by product and risk class"""
 
     for prod in params.Product:
-        output_path = '{0}\{1}'.format(os.getcwd(), prod)
+        output_path = os.path.join(os.getcwd(), prod)
         if os.path.exists(output_path):
             shutil.rmtree(output_path)
 
@@ -41,381 +43,588 @@ def prep_output_directory(params):
 
     for prod in params.Product:
         for risk in params.RiskType:
-            output_path = '{0}\{1}\{2}'.format(os.getcwd(), prod, risk)
+            output_path = os.path.join(os.getcwd(), prod, risk)
             if not os.path.exists(output_path):
                 os.mkdir(output_path)
 
-    output_path = '{0}\simm_all_margin.csv'.format(os.getcwd())
-    if os.path.exists(output_path):
-        os.remove(output_path)
+    for output_file in ['simm_all_margin.csv', 'simm_all_margin.parquet']:
+        output_path = os.path.join(os.getcwd(), output_file)
+        if os.path.exists(output_path):
+            os.remove(output_path)
 
-def risk_classification(trades_pos, params):
-    """Risk class classification in terms of RiskType"""
+class ResultsSink(object):
+    """Intermediate bucket and risk class results of the margin calculation
 
-    # Check product type
-    trades_pos_no_product = trades_pos[~trades_pos.ProductClass.isin(params.Product)].copy()
-    if len(trades_pos_no_product) > 0:
-        logger.info('{0} trades missed Product Class'.format(len(trades_pos_no_product)))
-        trades_pos_no_product['reason'] = 'Product'
+    Tables are buffered in memory per output file, named relative to the working directory without
+    extension, and written in bulk by flush as csv or parquet. A sink without a file format discards
+    them, an unbuffered sink writes every table as it arrives.
+    """
 
-    trades_pos = trades_pos[trades_pos.ProductClass.isin(params.Product)].copy()
+    Formats = ['csv', 'parquet']
+
+    def __init__(self, file_format='csv', buffered=True):
+        self.file_format = file_format
+        self.buffered = buffered
+        self.tables = []
+
+    def append(self, name, table):
+        if self.file_format is None:
+            return
+
+        self.tables.append((name, table))
+
+        if not self.buffered:
+            self.flush()
+
+    def extend(self, tables):
+        for name, table in tables:
+            self.append(name, table)
+
+    def flush(self):
+        """Write the buffered tables, one bulk write per output file"""
+
+        tables = self.tables
+        self.tables = []
+
+        self.write(tables)
+
+    def close(self):
+        self.flush()
+
+    def write(self, tables):
+        names = []
+        name_tables = {}
+        for name, table in tables:
+            if name not in name_tables:
+                names.append(name)
+                name_tables[name] = []
+            name_tables[name].append(table)
+
+        for name in names:
+            file_name = '{0}.{1}'.format(name, self.file_format)
+
+            if self.file_format == 'csv':
+                # Tables are appended in turn under the header of the first one
+                header = not os.path.isfile(file_name)
+                with open(file_name, 'a') as f:
+                    for table in name_tables[name]:
+                        table.to_csv(f, header=header, index=False)
+                        header = False
+            else:
+                table = pd.concat(name_tables[name])
+                if os.path.isfile(file_name):
+                    table = pd.concat([pd.read_parquet(file_name), table])
+                table.to_parquet(file_name, index=False)
+
+class BackgroundResultsSink(ResultsSink):
+    """Results sink writing its tables on a background thread
+
+    append puts a table on a bounded queue and returns, blocking only while the queue is full. A single
+    writer thread takes the tables in arrival order and writes whatever has queued up in one batch, so
+    the files come out as with a buffered sink. Parquet files, which cannot be appended to, are written
+    once the sink is closed. A failed write stops the writing and its error is raised by close.
+    """
+
+    def __init__(self, file_format='csv', queue_size=64):
+        ResultsSink.__init__(self, file_format)
+        self.queue = queue.Queue(queue_size)
+        self.error = None
+
+        self.writer = threading.Thread(target=self.write_queued, name='ResultsWriter')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def append(self, name, table):
+        if self.file_format is None:
+            return
+
+        self.queue.put((name, table))
+
+    def flush(self):
+        """Wait until the writer has taken the queued tables"""
+
+        self.queue.join()
+
+    def close(self):
+        """Write the remaining tables, stop the writer and raise its error if a write failed"""
+
+        self.queue.put(None)
+        self.writer.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def write_queued(self):
+        stop = False
+        while not stop:
+            # Everything queued since the last write goes into one batch
+            batch = [self.queue.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
 
-    # Determine risk class
-    trades_pos['RiskClass'] = np.NaN
-    trades_pos.ix[trades_pos.RiskType.isin(params.IR), 'RiskClass'] = 'IR'
-    trades_pos.ix[trades_pos.RiskType.isin(params.CreditQ), 'RiskClass'] = 'CreditQ'
-    trades_pos.ix[trades_pos.RiskType.isin(params.CreditNonQ), 'RiskClass'] = 'CreditNonQ'
-    trades_pos.ix[trades_pos.RiskType.isin(params.Equity), 'RiskClass'] = 'Equity'
-    trades_pos.ix[trades_pos.RiskType.isin(params.FX), 'RiskClass'] = 'FX'
-    trades_pos.ix[trades_pos.RiskType.isin(params.Commodity), 'RiskClass'] = 'Commodity'
+            stop = batch[-1] is None
+            tables = [item for item in batch if item is not None]
 
-    trades_pos_no_risk_class = trades_pos[~trades_pos.RiskClass.isin(params.RiskType)].copy()
-    if len(trades_pos_no_risk_class) > 0:
-        logger.info('{0} trades can not be classified for risk class'.format(len(trades_pos_no_risk_class)))
-        trades_pos_no_risk_class['reason'] = 'RiskType'
+            if self.error is None:
+                try:
+                    if self.file_format == 'csv':
+                        self.write(tables)
+                    else:
+                        self.tables.extend(tables)
 
-    trades_pos = trades_pos[trades_pos.RiskClass.isin(params.RiskType)].copy()
+                    if stop:
+                        ResultsSink.flush(self)
+                except Exception as e:
+                    logger.error('Failed to write intermediate results: {0}'.format(e))
+                    self.error = e
 
-    # Check qualifier
-    trades_pos_no_qualifier = trades_pos[trades_pos.Qualifier.isnull()].copy()
-    if len(trades_pos_no_qualifier) > 0:
-        logger.info('{0} trades missed Qualifiers'.format(len(trades_pos_no_qualifier)))
-        trades_pos_no_risk_class['reason'] = 'Qualifiers'
+            for item in batch:
+                self.queue.task_done()
 
-    trades_pos = trades_pos[trades_pos.Qualifier.notnull()].copy()
-    trades_pos['reason'] = 'Good'
+# Intermediate results of library calls are written as they arrive, main installs a buffered sink
+results_sink = ResultsSink(buffered=False)
 
-    trades_pos = pd.concat([trades_pos, trades_pos_no_product, trades_pos_no_risk_class, trades_pos_no_qualifier])
+def set_results_sink(sink):
+    """Send intermediate results of the margin calculation to sink"""
 
-    return trades_pos
+    global results_sink
+    results_sink = sink
 
-def prep_data_IRCurve(pos, params):
-    """Check data quality for IR Curve factor"""
+# Data quality checks in order of precedence, the reason of a row being its first failed check
+Data_Quality_Reasons = ['Product', 'RiskType', 'Qualifiers', 'Bucket', 'Label1', 'Label2']
 
-    # Check Bucket
-    pos_no_bucket = pos[~pos.Bucket.isin(params.IR_Bucket)].copy()
-    if len(pos_no_bucket) > 0:
-        logger.info('{0} IR Curve trades have wrong Bucket'.format(len(pos_no_bucket)))
-        pos_no_bucket['reason'] = 'Bucket'
+def risk_classification(trades_pos, params):
+    """Risk class of every row in terms of RiskType, missing for unknown risk types"""
+
+    risk_class = np.empty(len(trades_pos), dtype=object)
+    risk_class.fill(np.NaN)
+
+    risk_class[trades_pos.RiskType.isin(params.IR).values] = 'IR'
+    risk_class[trades_pos.RiskType.isin(params.CreditQ).values] = 'CreditQ'
+    risk_class[trades_pos.RiskType.isin(params.CreditNonQ).values] = 'CreditNonQ'
+    risk_class[trades_pos.RiskType.isin(params.Equity).values] = 'Equity'
+    risk_class[trades_pos.RiskType.isin(params.FX).values] = 'FX'
+    risk_class[trades_pos.RiskType.isin(params.Commodity).values] = 'Commodity'
+
+    return risk_class
+
+def check_trade_pos(trades_pos, risk_class, params):
+    """Failed mask of every check of Data_Quality_Reasons and the report group of every row"""
+
+    is_IR = risk_class == 'IR'
+    is_IRCurve = is_IR & (trades_pos.RiskType == 'Risk_IRCurve').values
+    is_IRVol = is_IR & trades_pos.RiskType.isin(['Risk_IRVol', 'Risk_IRCV']).values
+    is_Inflation = is_IR & (trades_pos.RiskType == 'Risk_Inflation').values
+    is_USD = (trades_pos.Qualifier == 'USD').values
+
+    label_checks = [
+        ('Bucket', [(is_IRCurve, params.IR_Bucket),
+                    (risk_class == 'CreditQ', params.CreditQ_Bucket),
+                    (risk_class == 'CreditNonQ', params.CreditNonQ_Bucket),
+                    (risk_class == 'Equity', params.Equity_Bucket),
+                    (risk_class == 'Commodity', params.Commodity_Bucket)]),
+        ('Label1', [(is_IRCurve | is_IRVol, params.IR_Tenor),
+                    (risk_class == 'CreditQ', params.CreditQ_Tenor),
+                    (risk_class == 'CreditNonQ', params.CreditNonQ_Tenor)]),
+        ('Label2', [(is_IRCurve & is_USD, params.IR_USD_Sub_Curve),
+                    (is_IRCurve & ~is_USD, params.IR_Sub_Curve)])]
+
+    failed = [~trades_pos.ProductClass.isin(params.Product).values,
+              pd.isnull(risk_class),
+              trades_pos.Qualifier.isnull().values]
+
+    for column, checks in label_checks:
+        is_failed = np.zeros(len(trades_pos), dtype=bool)
+        for is_checked, labels in checks:
+            is_failed |= is_checked & ~trades_pos[column].isin(labels).values
+
+        failed.append(is_failed)
+
+    # Rows are reported by risk type group, IR curve, vol and inflation first
+    report_groups = [is_IRCurve, is_IRVol, is_Inflation, risk_class == 'CreditQ', risk_class == 'CreditNonQ',
+                     risk_class == 'Equity', risk_class == 'Commodity', risk_class == 'FX']
+
+    group = np.zeros(len(trades_pos), dtype=np.int8)
+    group.fill(len(report_groups))
+    for i in reversed(range(len(report_groups))):
+        group[report_groups[i]] = i
+
+    return failed, group
+
+def validate_trade_pos(trades_pos, params):
+    """Classify and check every row in one pass, adding RiskClass and the reason column
+
+    Rows come out once, ordered by report group with the good rows of a group ahead of its rejections
+    in check order, and the rows failing product, risk type or qualifier checks at the end.
+    """
+
+    risk_class = risk_classification(trades_pos, params)
+    failed, group = check_trade_pos(trades_pos, risk_class, params)
+
+    codes = np.zeros(len(trades_pos), dtype=np.int8)
+    for code, is_failed in enumerate(failed, 1):
+        is_reason = (codes == 0) & is_failed
+        codes[is_reason] = code
+
+        if is_reason.any():
+            logger.info('{0} trades have wrong {1}'.format(is_reason.sum(), Data_Quality_Reasons[code - 1]))
+
+    # Rows without a product class are left unclassified, rows failing classification are reported last
+    risk_class[codes == 1] = np.NaN
+    group[(codes > 0) & (codes <= 3)] = group.max() + 1
+
+    order = np.lexsort((codes, group))
+
+    # Reasons as reported so far: with any qualifier missing, rows of unknown risk type are reported
+    # as Qualifiers and rows missing their qualifier have no reason
+    reason_codes = np.arange(len(Data_Quality_Reasons) + 1)
+    if (codes == 3).any():
+        reason_codes[2] = 3
+        reason_codes[3] = -1
+
+    trades_pos = trades_pos.iloc[order].copy()
+    trades_pos['RiskClass'] = risk_class[order]
+    trades_pos['reason'] = pd.Categorical.from_codes(reason_codes[codes[order]], ['Good'] + Data_Quality_Reasons)
 
-    pos = pos[pos.Bucket.isin(params.IR_Bucket)].copy()
+    return trades_pos
 
-    # Check Label1
-    pos_no_label1 = pos[~pos.Label1.isin(params.IR_Tenor)].copy()
-    if len(pos_no_label1) > 0:
-        logger.info('{0} IR Curve trades have wrong Label 1'.format(len(pos_no_label1)))
-        pos_no_label1['reason'] = 'Label1'
+def calc_delta_margin(pos, params):
+    pos_delta = pos[pos.RiskType.isin(params.Delta_Factor)].copy()
 
-    pos = pos[pos.Label1.isin(params.IR_Tenor)].copy()
+    pos_delta_margin_gp = []
+    pos_delta_margin = []
 
-    # Check Label2
-    pos_no_label2 = pos[~(((pos.Qualifier == 'USD') & pos.Label2.isin(params.IR_USD_Sub_Curve)) |
-                          ((pos.Qualifier != 'USD') & pos.Label2.isin(params.IR_Sub_Curve)))].copy()
+    if len(pos_delta) > 0:
+        delta_margin_loader = delta_margin.DeltaMargin()
+        pos_delta_margin = margin_risk_factor(pos_delta, params, delta_margin_loader)
 
-    if len(pos_no_label2) > 0:
-        logger.info('{0} IR Curve trades have wrong Label 2'.format(len(pos_no_label2)))
-        pos_no_label2['reason'] = 'Label2'
+    if len(pos_delta_margin) > 0:
+        pos_delta_margin_gp = pos_delta_margin.groupby(['CombinationID', 'ProductClass', 'RiskClass'], observed=True)
+        pos_delta_margin_gp = pos_delta_margin_gp.agg({'Margin': np.sum}).sort_index()
+        pos_delta_margin_gp.reset_index(inplace=True)
+        pos_delta_margin_gp['MarginType'] = 'Delta'
 
-    pos = pos[((pos.Qualifier == 'USD') & pos.Label2.isin(params.IR_USD_Sub_Curve)) |
-              ((pos.Qualifier != 'USD') & pos.Label2.isin(params.IR_Sub_Curve))].copy()
+    return pos_delta_margin_gp
 
-    pos = pd.concat([pos, pos_no_bucket, pos_no_label1, pos_no_label2])
+def calc_vega_margin(pos, params):
+    pos_vega = pos[pos.RiskType.isin(params.Vega_Factor)].copy()
 
-    return pos
+    pos_vega_margin_gp = []
+    pos_vega_margin = []
 
-def prep_data_IRVol(pos, params):
-    """Check data quality for IR Vol factor"""
+    if len(pos_vega) > 0:
+        vega_margin_loader = vega_margin.VegaMargin()
+        pos_vega_margin = margin_risk_factor(pos_vega, params, vega_margin_loader)
 
-    # Check Label1
-    pos_no_label1 = pos[~pos.Label1.isin(params.IR_Tenor)].copy()
-    if len(pos_no_label1) > 0:
-        logger.info('{0} IR Vol trades have wrong Label 1'.format(len(pos_no_label1)))
-        pos_no_label1['reason'] = 'Label1'
+    if len(pos_vega_margin) > 0:
+        pos_vega_margin_gp = pos_vega_margin.groupby(['CombinationID', 'ProductClass', 'RiskClass'], observed=True)
+        pos_vega_margin_gp = pos_vega_margin_gp.agg({'Margin': np.sum}).sort_index()
+        pos_vega_margin_gp.reset_index(inplace=True)
+        pos_vega_margin_gp['MarginType'] = 'Vega'
 
-    pos = pos[pos.Label1.isin(params.IR_Tenor)].copy()
+    return pos_vega_margin_gp
 
-    pos = pd.concat([pos, pos_no_label1])
+def calc_curvature_margin(pos, params):
+    pos_curvature = pos[pos.RiskType.isin(params.Curvature_Factor)].copy()
 
-    return pos
+    pos_curvature_margin_gp = []
+    pos_curvature_margin = []
 
-def prep_data_IR(pos, params):
-    """Check data quality for IR factor"""
+    if len(pos_curvature) > 0:
+        curvature_margin_loader = curvature_margin.CurvatureMargin()
+        pos_curvature_margin = margin_risk_factor(pos_curvature, params, curvature_margin_loader)
 
-    # Check IR curve
-    pos_IRCurve = pos[pos.RiskType == 'Risk_IRCurve'].copy()
-    pos_IRCurve = prep_data_IRCurve(pos_IRCurve, params)
+    if len(pos_curvature_margin) > 0:
+        pos_curvature_margin_gp = pos_curvature_margin.groupby(['CombinationID', 'ProductClass', 'RiskClass'], observed=True)
+        pos_curvature_margin_gp = pos_curvature_margin_gp.agg({'Margin': np.sum}).sort_index()
+        pos_curvature_margin_gp.reset_index(inplace=True)
+        pos_curvature_margin_gp['MarginType'] = 'Curvature'
 
-    # Check IR vol and curvature
-    pos_IRVol = pos[pos.RiskType.isin(['Risk_IRVol', 'Risk_IRCV'])].copy()
-    pos_IRVol = prep_data_IRVol(pos_IRVol, params)
+    return pos_curvature_margin_gp
 
-    # Check IR inflation
-    pos_Inflation = pos[pos.RiskType == 'Risk_Inflation'].copy()
+def sort_risk_groups(groups, risk_class):
+    """Sort buckets numerically with Residual placed last"""
 
-    pos = pd.concat([pos_IRCurve, pos_IRVol, pos_Inflation])
+    groups = list(groups)
+    groups.sort()
 
-    return pos
+    if risk_class in ['CreditQ', 'CreditNonQ', 'Equity', 'Commodity']:
 
-def prep_data_CreditQ(pos, params):
-    """Check data quality for CreditQ factor"""
+        groups_copy = list(groups)
 
-    # Check Bucket
-    pos_no_bucket = pos[~pos.Bucket.isin(params.CreditQ_Bucket)].copy()
-    if len(pos_no_bucket) > 0:
-        logger.info('{0} CreditQ trades have wrong Bucket'.format(len(pos_no_bucket)))
-        pos_no_bucket['reason'] = 'Bucket'
+        if 'Residual' in groups:
+            groups.remove('Residual')
 
-    pos = pos[pos.Bucket.isin(params.CreditQ_Bucket)].copy()
+        groups = [int(d) for d in groups]
+        groups.sort()
+        groups = [str(d) for d in groups]
 
-    # Check Label1
-    pos_no_label1 = pos[~pos.Label1.isin(params.CreditQ_Tenor)].copy()
-    if len(pos_no_label1) > 0:
-        logger.info('{0} CreditQ trades have wrong Label 1'.format(len(pos_no_label1)))
-        pos_no_label1['reason'] = 'Label1'
+        if 'Residual' in groups_copy:
+            groups.append('Residual')
 
-    pos = pos[pos.Label1.isin(params.CreditQ_Tenor)].copy()
+    return groups
 
-    pos = pd.concat([pos, pos_no_bucket, pos_no_label1])
+def calculate_risk_class_margin(K, SS, CVR_sum, CVR_abs_sum, is_residual, risk_class, params, margin_type):
+    """Aggregate bucket K and S of one CombinationID into the risk class margin
 
-    return pos
+    K, CVR_sum, CVR_abs_sum and is_residual hold one entry per bucket, the curvature sums being None
+    for delta and vega, and SS is the inter-bucket term S * g * S' of the non residual buckets.
+    """
 
-def prep_data_CreditNonQ(pos, params):
-    """Check data quality for CreditNonQ factor"""
+    is_non_residual = ~is_residual
 
-    # Check Bucket
-    pos_no_bucket = pos[~pos.Bucket.isin(params.CreditNonQ_Bucket)].copy()
-    if len(pos_no_bucket) > 0:
-        logger.info('{0} CreditNonQ trades have wrong Bucket'.format(len(pos_no_bucket)))
-        pos_no_bucket['reason'] = 'Bucket'
+    delta_margin = 0
+    if is_non_residual.any():
+        K_non_residual = K[is_non_residual]
+        delta_margin = math.sqrt(np.dot(K_non_residual, K_non_residual) + SS)
 
-    pos = pos[pos.Bucket.isin(params.CreditNonQ_Bucket)].copy()
+        if margin_type == 'Curvature':
+            CVR_sum_non_residual = CVR_sum[is_non_residual].sum()
 
-    # Check Label1
-    pos_no_label1 = pos[~pos.Label1.isin(params.CreditNonQ_Tenor)].copy()
-    if len(pos_no_label1) > 0:
-        logger.info('{0} CreditNonQ trades have wrong Label 1'.format(len(pos_no_label1)))
-        pos_no_label1['reason'] = 'Label1'
+            theta = min(CVR_sum_non_residual / CVR_abs_sum[is_non_residual].sum(), 0)
+            lambda_const = (pow(norm.ppf(0.995), 2) - 1) * (1 + theta) - theta
 
-    pos = pos[pos.Label1.isin(params.CreditNonQ_Tenor)].copy()
+            delta_margin = max(lambda_const * delta_margin + CVR_sum_non_residual, 0)
 
-    pos = pd.concat([pos, pos_no_bucket, pos_no_label1])
+    if is_residual.any():
+        residual = np.flatnonzero(is_residual)[0]
 
-    return pos
+        if margin_type == 'Curvature':
+            theta = min(CVR_sum[residual] / CVR_abs_sum[residual], 0)
+            lambda_const = (pow(norm.ppf(0.995), 2) - 1) * (1 + theta) - theta
 
-def prep_data_Equity(pos, params):
-    """Check data quality for Equity factor"""
+            delta_margin = delta_margin + max(CVR_sum[residual] + lambda_const * K[residual], 0)
+        else:
+            delta_margin = delta_margin + K[residual]
 
-    # Check Bucket
-    pos_no_bucket = pos[~pos.Bucket.isin(params.Equity_Bucket)].copy()
-    if len(pos_no_bucket) > 0:
-        logger.info('{0} Equity trades have wrong Bucket'.format(len(pos_no_bucket)))
-        pos_no_bucket['reason'] = 'Bucket'
+    if margin_type == 'Curvature' and risk_class == 'IR':
+        delta_margin = delta_margin * params.IR_Curvature_Margin_Scale
 
-    pos = pos[pos.Bucket.isin(params.Equity_Bucket)].copy()
+    return delta_margin
 
-    pos = pd.concat([pos, pos_no_bucket])
+def risk_group_column(risk_class):
+    """Column splitting the netted sensitivities of a risk class into buckets"""
 
-    return pos
+    if risk_class == 'IR':
+        group = 'Qualifier'
+    elif risk_class == 'FX':
+        group = 'RiskType'
+    else:
+        group = 'Bucket'
 
-def prep_data_Commodity(pos, params):
-    """Check data quality for Commodity factor"""
+    return group
 
-    # Check Bucket
-    pos_no_bucket = pos[~pos.Bucket.isin(params.Commodity_Bucket)].copy()
-    if len(pos_no_bucket) > 0:
-        logger.info('{0} Commodity trades have wrong Bucket'.format(len(pos_no_bucket)))
-        pos_no_bucket['reason'] = 'Bucket'
+def prepare_risk_factors(pos, params, margin_loader):
+    """Net sensitivities of one risk class for every CombinationID in pos and attach concentration risk"""
 
-    pos = pos[pos.Bucket.isin(params.Commodity_Bucket)].copy()
+    if margin_loader.margin_type() == 'Curvature':
+        pos = margin_loader.input_scaling(pos)
 
-    pos = pd.concat([pos, pos_no_bucket])
+    pos_delta = margin_loader.net_sensitivities(pos, params)
 
-    return pos
+    risk_class = pos_delta.RiskClass.unique()[0]
+    group = risk_group_column(risk_class)
 
-def prep_data(pos, params):
-    """Check data quality for all risk factors"""
+    # Risk_Group, CR_THR and CR are attached to the netted sensitivities of all combinations at once
+    pos_delta = mlib.attach_concentration_risk(pos_delta, params, margin_loader,
+                                               ['CombinationID', group, 'Qualifier', 'Risk_Group'])
 
-    pos_IR = pos[pos.RiskClass == 'IR'].copy()
-    pos_IR = prep_data_IR(pos_IR, params)
+    return pos_delta
 
-    pos_CreditQ = pos[pos.RiskClass == 'CreditQ'].copy()
-    pos_CreditQ = prep_data_CreditQ(pos_CreditQ, params)
+def build_bucket_states(pos_delta, params, margin_loader):
+    """Evaluate WS, CR, correlation, K and the margin row of every bucket of every CombinationID"""
 
-    pos_CreditNonQ = pos[pos.RiskClass == 'CreditNonQ'].copy()
-    pos_CreditNonQ = prep_data_CreditNonQ(pos_CreditNonQ, params)
+    risk_class = pos_delta.RiskClass.unique()[0]
+    group = risk_group_column(risk_class)
 
-    pos_Equity = pos[pos.RiskClass == 'Equity'].copy()
-    pos_Equity = prep_data_Equity(pos_Equity, params)
+    # Net sensitivities of all combinations are split into buckets with a single groupby
+    case_groups = pos_delta.groupby('CombinationID', sort=False, observed=True)[group].unique()
+    pos_delta_gps = dict(list(pos_delta.groupby(['CombinationID', group], sort=False, observed=True)))
 
-    pos_Commodity = pos[pos.RiskClass == 'Commodity'].copy()
-    pos_Commodity = prep_data_Commodity(pos_Commodity, params)
+    states = []
+    for case in case_groups.index:
+        for gp in sort_risk_groups(case_groups[case], risk_class):
+            pos_delta_gp = pos_delta_gps[(case, gp)].reset_index(drop=True)
+            pos_delta_gp, WS, CR, Corr = margin_loader.build_weighted_risk(pos_delta_gp, params)
 
-    pos_FX = pos[pos.RiskClass == 'FX'].copy()
+            states.append(mlib.BucketState(case, gp, pos_delta_gp, WS, CR, Corr))
 
-    return pd.concat([pos_IR, pos_CreditQ, pos_CreditNonQ, pos_Equity, pos_Commodity, pos_FX])
+    # Evaluate K = sqrt(WS * Corr * WS') of every bucket as stacked matrix products
+    K_all = np.sqrt(mlib.batch_quadratic_form([state.WS for state in states], [state.Corr for state in states]))
 
-def calc_delta_margin(pos, params):
-    pos_delta = pos[pos.RiskType.isin(params.Delta_Factor)].copy()
+    for state, K in zip(states, K_all):
+        state.K = K
+        state.set_margin(margin_loader.build_margin_risk_group(state.pos, state.WS, state.CR, K))
 
-    pos_delta_margin_gp = []
-    pos_delta_margin = []
+    return states
 
-    if len(pos_delta) > 0:
-        delta_margin_loader = delta_margin.DeltaMargin()
-        pos_delta_margin = margin_risk_factor(pos_delta, params, delta_margin_loader)
+def aggregate_bucket_states(case_states, params, margin_type):
+    """Risk class margin of every CombinationID from the bucket states of the combination
 
-    if len(pos_delta_margin) > 0:
-        pos_delta_margin_gp = pos_delta_margin.groupby(['CombinationID', 'ProductClass', 'RiskClass'])
-        pos_delta_margin_gp = pos_delta_margin_gp.agg({'Margin': np.sum})
-        pos_delta_margin_gp.reset_index(inplace=True)
-        pos_delta_margin_gp['MarginType'] = 'Delta'
+    Buckets enter as arrays of their K, S, concentration and curvature sums, placed in the inter-bucket
+    S vector through the bucket label index, without building a frame per bucket.
+    """
 
-    return pos_delta_margin_gp
+    risk_class = case_states[0][0].pos.RiskClass.values[0]
 
-def calc_vega_margin(pos, params):
-    pos_vega = pos[pos.RiskType.isin(params.Vega_Factor)].copy()
+    case_arrays = []
+    for states in case_states:
+        groups = np.array([state.group for state in states], dtype=object)
+        is_residual = groups == 'Residual'
 
-    pos_vega_margin_gp = []
-    pos_vega_margin = []
+        K = np.array([state.K for state in states], dtype=np.float64)
+        S = np.array([state.S for state in states], dtype=np.float64)
 
-    if len(pos_vega) > 0:
-        vega_margin_loader = vega_margin.VegaMargin()
-        pos_vega_margin = margin_risk_factor(pos_vega, params, vega_margin_loader)
+        CVR_sum = None
+        CVR_abs_sum = None
+        if margin_type == 'Curvature':
+            CVR_sum = np.array([state.CVR_sum for state in states], dtype=np.float64)
+            CVR_abs_sum = np.array([state.CVR_abs_sum for state in states], dtype=np.float64)
 
-    if len(pos_vega_margin) > 0:
-        pos_vega_margin_gp = pos_vega_margin.groupby(['CombinationID', 'ProductClass', 'RiskClass'])
-        pos_vega_margin_gp = pos_vega_margin_gp.agg({'Margin': np.sum})
-        pos_vega_margin_gp.reset_index(inplace=True)
-        pos_vega_margin_gp['MarginType'] = 'Vega'
+        case_arrays.append((groups, is_residual, K, S, CVR_sum, CVR_abs_sum))
 
-    return pos_vega_margin_gp
+    # Inter-bucket aggregation S * g * S' of all combinations as stacked matrix products
+    SS_all = np.zeros(len(case_states))
+    if risk_class != 'FX':
+        S_all = []
+        g_all = []
+        SS_cases = []
+        for i in range(len(case_states)):
+            groups, is_residual, K, S, CVR_sum, CVR_abs_sum = case_arrays[i]
+            if not is_residual.all():
+                idx = mlib.build_group_index(groups[~is_residual], risk_class, params)
+                S_all.append(mlib.scatter_bucket_S(S[~is_residual], idx, risk_class, params))
 
-def calc_curvature_margin(pos, params):
-    pos_curvature = pos[pos.RiskType.isin(params.Curvature_Factor)].copy()
+                CR = np.array([state.bucket_CR for state in case_states[i]], dtype=np.float64)
+                g_all.append(mlib.build_group_correlation(risk_class, CR, params, margin_type))
+                SS_cases.append(i)
 
-    pos_curvature_margin_gp = []
-    pos_curvature_margin = []
+        SS_all[SS_cases] = mlib.batch_quadratic_form(S_all, g_all)
 
-    if len(pos_curvature) > 0:
-        curvature_margin_loader = curvature_margin.CurvatureMargin()
-        pos_curvature_margin = margin_risk_factor(pos_curvature, params, curvature_margin_loader)
+    margins = np.zeros(len(case_states))
+    for i in range(len(case_states)):
+        groups, is_residual, K, S, CVR_sum, CVR_abs_sum = case_arrays[i]
+        margins[i] = calculate_risk_class_margin(K, SS_all[i], CVR_sum, CVR_abs_sum, is_residual, risk_class, params, margin_type)
 
-    if len(pos_curvature_margin) > 0:
-        pos_curvature_margin_gp = pos_curvature_margin.groupby(['CombinationID', 'ProductClass', 'RiskClass'])
-        pos_curvature_margin_gp = pos_curvature_margin_gp.agg({'Margin': np.sum})
-        pos_curvature_margin_gp.reset_index(inplace=True)
-        pos_curvature_margin_gp['MarginType'] = 'Curvature'
+    return margins
 
-    return pos_curvature_margin_gp
+def calculate_risk_class_margin_gradient(pos_delta, params, margin_type):
+    """Partial derivatives of the risk class margin of one CombinationID to the K, S, CVR_sum and CVR_abs_sum
+    of every bucket row of pos_delta, holding the inter-bucket correlation fixed
+    """
 
-def margin_risk_factor(pos, params, margin_loader):
-    """Calculate Delta Margin for IR Class"""
+    risk_class = pos_delta.RiskClass.unique()[0]
+    q = pow(norm.ppf(0.995), 2)
 
-    if margin_loader.margin_type() == 'Curvature':
-        pos = margin_loader.input_scaling(pos)
+    dK = np.zeros(len(pos_delta))
+    dS = np.zeros(len(pos_delta))
+    dCVR_sum = np.zeros(len(pos_delta))
+    dCVR_abs_sum = np.zeros(len(pos_delta))
 
-    pos_delta = margin_loader.net_sensitivities(pos, params)
+    is_residual = (pos_delta.Group == 'Residual').values
+    is_non_residual = ~is_residual
 
-    product_class = pos_delta.ProductClass.unique()[0]
-    risk_class = pos_delta.RiskClass.unique()[0]
-    risk_type = pos_delta.RiskType.unique()[0]
+    if is_non_residual.any():
+        pos_delta_non_residual = pos_delta[is_non_residual].copy()
+        K = pos_delta_non_residual.K.values
 
-    if risk_class == 'IR':
-        group = 'Qualifier'
-    elif risk_class == 'FX':
-        group = 'RiskType'
-    else:
-        group = 'Bucket'
+        gS = np.zeros(len(K))
+        SS = 0
+        if risk_class != 'FX':
+            S = np.asarray(mlib.build_non_residual_S(pos_delta_non_residual.copy(), params), dtype=np.float64)
+            g = np.asarray(mlib.build_bucket_correlation(pos_delta, params, margin_type), dtype=np.float64)
+            SS = np.dot(S, np.dot(g, S))
+            idx = mlib.build_bucket_index(pos_delta_non_residual, params)
+            gS = np.where(idx >= 0, np.dot(g, S)[idx], 0)
+
+        R = math.sqrt(np.dot(K, K) + SS)
+        dR = 1.0
+        if margin_type == 'Curvature':
+            A = pos_delta_non_residual.CVR_sum.sum()
+            B = pos_delta_non_residual.CVR_abs_sum.sum()
+
+            theta = min(A / B, 0)
+            lambda_const = (q - 1) * (1 + theta) - theta
+
+            dR = 0
+            if lambda_const * R + A > 0:
+                dR = lambda_const
+                dCVR_sum[is_non_residual] = 1
+                if theta < 0:
+                    dCVR_sum[is_non_residual] = 1 + (q - 2) * R / B
+                    dCVR_abs_sum[is_non_residual] = -(q - 2) * R * A / pow(B, 2)
+
+        if R > 0:
+            dK[is_non_residual] = dR * K / R
+            dS[is_non_residual] = dR * gS / R
+
+    if is_residual.any():
+        dK[is_residual] = 1
+
+        if margin_type == 'Curvature':
+            K = pos_delta.K.values[is_residual][0]
+            CVR_sum = pos_delta.CVR_sum.values[is_residual][0]
+            CVR_abs_sum = pos_delta.CVR_abs_sum.values[is_residual][0]
 
-    groups = pos_delta[group].unique().tolist()
-    groups.sort()
+            theta = min(CVR_sum / CVR_abs_sum, 0)
+            lambda_const = (q - 1) * (1 + theta) - theta
 
-    if risk_class in ['CreditQ', 'CreditNonQ', 'Equity', 'Commodity']:
+            dK[is_residual] = 0
+            if CVR_sum + lambda_const * K > 0:
+                dK[is_residual] = lambda_const
+                dCVR_sum[is_residual] = 1
+                if theta < 0:
+                    dCVR_sum[is_residual] = 1 + (q - 2) * K / CVR_abs_sum
+                    dCVR_abs_sum[is_residual] = -(q - 2) * K * CVR_sum / pow(CVR_abs_sum, 2)
 
-        groups_copy = list(groups)
+    if margin_type == 'Curvature' and risk_class == 'IR':
+        scale = params.IR_Curvature_Margin_Scale
+        dK, dS, dCVR_sum, dCVR_abs_sum = dK * scale, dS * scale, dCVR_sum * scale, dCVR_abs_sum * scale
 
-        if 'Residual' in groups:
-            groups.remove('Residual')
+    return dK, dS, dCVR_sum, dCVR_abs_sum
 
-        groups = [int(d) for d in groups]
-        groups.sort()
-        groups = [str(d) for d in groups]
+def margin_risk_factor(pos, params, margin_loader):
+    """Calculate margin of one risk class for every CombinationID in pos"""
 
-        if 'Residual' in groups_copy:
-            groups.append('Residual')
+    pos_delta = prepare_risk_factors(pos, params, margin_loader)
 
-    pos_delta_gp_all = []
-    for gp in groups:
-        pos_delta_gp = pos_delta[pos_delta[group] == gp].copy()
-        pos_delta_gp = margin_loader.margin_risk_group(pos_delta_gp, params)
-        pos_delta_gp_all.append(pos_delta_gp)
+    product_class = pos_delta.ProductClass.unique()[0]
+    risk_class = pos_delta.RiskClass.unique()[0]
 
-    pos_delta_gp_all = pd.concat(pos_delta_gp_all)
+    case_risk_types = pos_delta.groupby('CombinationID', sort=False, observed=True).RiskType.first()
 
-    pos_delta = pos_delta_gp_all.copy()
+    states = build_bucket_states(pos_delta, params, margin_loader)
 
-    intermediate_path = '{0}\{1}\{2}'.format(os.getcwd(), product_class, risk_class)
-    file_name = '{0}\{1}_margin_group.csv'.format(intermediate_path, risk_type)
+    pos_delta = pd.concat([state.margin for state in states])
 
     if margin_loader.margin_type() == 'Curvature':
-        pos_delta_output = pos_delta.ix[:, pos_delta.columns != 'CVR_sum']
+        pos_delta_output = pos_delta.drop(columns='CVR_sum')
     else:
         pos_delta_output = pos_delta
 
-    if not os.path.isfile(file_name):
-        pos_delta_output.to_csv(file_name, index=False)
-    else:  # else it exists so append without writing the header
-        pos_delta_output.to_csv(file_name, mode='a', header=False, index=False)
+    for risk_type in case_risk_types.unique():
+        name = os.path.join(product_class, risk_class, '{0}_margin_group'.format(risk_type))
+        case_output = case_risk_types[case_risk_types == risk_type].index
+        results_sink.append(name, pos_delta_output[pos_delta_output.CombinationID.isin(case_output)])
 
-    g = mlib.build_bucket_correlation(pos_delta, params, margin_loader.margin_type())
+    case_states = {}
+    for state in states:
+        case_states.setdefault(state.case, []).append(state)
 
-    pos_delta_non_residual = pos_delta[pos_delta.Group != 'Residual'].copy()
-    pos_delta_residual = pos_delta[pos_delta.Group == 'Residual'].copy()
+    cases = case_risk_types.index
+    margins = aggregate_bucket_states([case_states[case] for case in cases], params, margin_loader.margin_type())
 
-    delta_margin = 0
-    if len(pos_delta_non_residual) > 0:
-        S = mlib.build_non_residual_S(pos_delta_non_residual, params)
-
-        if risk_class != 'FX':
-            SS = np.mat(S) * np.mat(g) * np.mat(np.reshape(S, (len(S), 1)))
-            SS = SS.item(0)
-        else:
-            SS = 0
-
-        delta_margin = math.sqrt(np.dot(pos_delta_non_residual.K, pos_delta_non_residual.K) + SS)
-
-        if margin_loader.margin_type() == 'Curvature':
-            theta = min(pos_delta_non_residual.CVR_sum.sum() / pos_delta_non_residual.CVR_abs_sum.sum(), 0)
-            lambda_const = (pow(norm.ppf(0.995), 2) - 1) * (1 + theta) - theta
-
-            delta_margin = max(lambda_const * delta_margin + pos_delta_non_residual.CVR_sum.sum(), 0)
-
-    if len(pos_delta_residual) > 0:
-        K = pos_delta_residual.K.values[0]
-
-        if margin_loader.margin_type() == 'Curvature':
-            CVR_sum = pos_delta_residual.CVR_sum.values[0]
-            CVR_abs_sum = pos_delta_residual.CVR_abs_sum.values[0]
-
-            theta = min(CVR_sum / CVR_abs_sum, 0)
-            lambda_const = (pow(norm.ppf(0.995), 2) - 1) * (1 + theta) - theta
-
-            delta_margin = delta_margin + max(CVR_sum + lambda_const * K, 0)
-        else:
-            delta_margin = delta_margin + K
-
-    if margin_loader.margin_type() == 'Curvature' and risk_class == 'IR':
-        delta_margin = delta_margin * params.IR_Curvature_Margin_Scale
-
-    ret_mm = pos_delta[['CombinationID','ProductClass', 'RiskClass']].copy()
-    ret_mm.drop_duplicates(inplace=True)
-    ret_mm['Margin'] = delta_margin
+    ret_mm = pd.DataFrame({'CombinationID': cases, 'ProductClass': product_class, 'RiskClass': risk_class,
+                           'Margin': margins}, columns=['CombinationID', 'ProductClass', 'RiskClass', 'Margin'])
 
     return ret_mm
 
 def calculate_in_product_margin(pos_gp, params):
 
-    risk_class_corr = params.Risk_Class_Corr
+    risk_class_corr = np.asarray(params.Risk_Class_Corr)
 
     pos_product_margin = []
     for product in pos_gp.ProductClass.unique():
@@ -423,20 +632,19 @@ def calculate_in_product_margin(pos_gp, params):
 
         pos_product = pos_gp[pos_gp.ProductClass == product].copy()
 
-        risk_margin = np.zeros(len(params.RiskType))
+        # One row of risk class margins per CombinationID, scattered by risk class position
+        case_idx, cases = pd.factorize(pos_product.CombinationID)
+        risk_idx = mlib.build_factor_index(np.asarray(pos_product.RiskClass), params.RiskType)
 
-        for i in range(len(params.RiskType)):
-            for j in range(len(pos_product.RiskClass)):
-                if pos_product.RiskClass.values[j] == params.RiskType[i]:
-                    risk_margin[i] = pos_product.Margin.values[j]
-                    break
+        is_known = risk_idx >= 0
+        risk_margin = np.zeros((len(cases), len(params.RiskType)))
+        risk_margin[case_idx[is_known], risk_idx[is_known]] = pos_product.Margin.values[is_known]
 
-        product_margin = np.mat(risk_margin) * np.mat(risk_class_corr) * np.mat(np.reshape(risk_margin, (len(risk_margin), 1)))
-        product_margin = math.sqrt(product_margin.item(0))
+        product_margin = mlib.batch_quadratic_form(list(risk_margin), [risk_class_corr] * len(risk_margin))
+        product_margin = np.sqrt(product_margin)
 
-        pos_product = pos_product[['CombinationID', 'ProductClass']].copy()
-        pos_product.drop_duplicates(inplace=True)
-        pos_product['Margin'] = product_margin
+        pos_product = pd.DataFrame({'CombinationID': cases, 'ProductClass': product, 'Margin': product_margin},
+                                   columns=['CombinationID', 'ProductClass', 'Margin'])
 
         pos_product_margin.append(pos_product)
 
@@ -445,7 +653,23 @@ def calculate_in_product_margin(pos_gp, params):
 
     return pos_product_margin
 
+def aggregate_product_margin(product_margin, params):
+    """SIMM of every CombinationID from its delta, vega and curvature margins per product and risk class"""
+
+    product_margin_gp = product_margin.groupby(['CombinationID', 'ProductClass', 'RiskClass'], observed=True)
+    product_margin_gp = product_margin_gp.agg({'Margin': np.sum}).sort_index()
+    product_margin_gp.reset_index(inplace=True)
+
+    product_margin_all = calculate_in_product_margin(product_margin_gp, params)
+
+    simm = product_margin_all.groupby('CombinationID', sort=False, observed=True).agg({'Margin': np.sum})
+    simm.reset_index(inplace=True)
+    simm.rename(columns={'Margin': 'SIMM_Benchmark'}, inplace=True)
+
+    return simm
+
 def calculate_simm(pos, params):
+    """Calculate SIMM for every CombinationID in the expanded run cases"""
 
     product_margin = []
 
@@ -467,38 +691,99 @@ def calculate_simm(pos, params):
                 product_margin.append(pos_gp_curvature_margin)
 
     product_margin = pd.concat(product_margin)
+    results_sink.append('simm_all_margin', product_margin)
 
-    if not os.path.isfile('simm_all_margin.csv'):
-        product_margin.to_csv('simm_all_margin.csv', index=False)
-    else:  # else it exists so append without writing the header
-        product_margin.to_csv('simm_all_margin.csv', mode='a', header=False, index=False)
+    return aggregate_product_margin(product_margin, params)
 
-    product_margin_gp = product_margin.groupby(['CombinationID', 'ProductClass', 'RiskClass'])
-    product_margin_gp = product_margin_gp.agg({'Margin': np.sum})
-    product_margin_gp.reset_index(inplace=True)
+class InputSource(object):
+    """Input tables of an Excel workbook, or of Parquet and Feather files selected by extension
 
-    product_margin_all = calculate_in_product_margin(product_margin_gp, params)
+    The workbook is opened once for all sheets. Table <sheet> of a columnar input <name>.parquet or
+    <name>.feather is stored in <name>.<sheet>.parquet or <name>.<sheet>.feather, of which only the
+    needed columns are read, with categorical RiskType, Qualifier, Bucket, Label1 and Label2.
+    """
 
-    simm = product_margin_all[['CombinationID']].drop_duplicates()
-    simm['SIMM_Benchmark'] = product_margin_all.Margin.sum()
+    Columnar_Formats = ['.parquet', '.feather']
+    Categorical_Columns = ['RiskType', 'Qualifier', 'Bucket', 'Label1', 'Label2']
 
-    return simm
+    def __init__(self, input_file):
+        self.input_file = input_file
+        self.root, self.extension = os.path.splitext(input_file)
+        self.extension = self.extension.lower()
+        self.excel_file = None
+
+    def is_columnar(self):
+        return self.extension in self.Columnar_Formats
+
+    def table_file(self, sheet):
+        return '{0}.{1}{2}'.format(self.root, sheet, self.extension)
+
+    def parse(self, sheet, columns, converters):
+        if not self.is_columnar():
+            if self.excel_file is None:
+                self.excel_file = pd.ExcelFile(self.input_file)
+
+            return self.excel_file.parse(sheet, converters=converters)
+
+        if self.extension == '.parquet':
+            table = pd.read_parquet(self.table_file(sheet), columns=columns)
+        else:
+            table = pd.read_feather(self.table_file(sheet), columns=columns)
+
+        for column, converter in converters.items():
+            if column in table and column not in self.Categorical_Columns:
+                values = table[column]
+                table[column] = values.where(values.isnull(), values.astype(converter))
+
+        for column in self.Categorical_Columns:
+            if column in table:
+                values = table[column]
+                table[column] = values.where(values.isnull(), values.astype(str)).astype('category')
+
+        return table
+
+def open_input(input_file):
+    """InputSource of an input file name, passing an already opened source through"""
+
+    if isinstance(input_file, InputSource):
+        return input_file
+
+    return InputSource(input_file)
+
+def categorize_labels(pos, params, columns=None):
+    """Convert label columns of a position frame to categoricals
+
+    Categories are the fixed label sets of params.Label_Categories plus any other values found, in
+    sorted order so that grouping on the categorical columns orders groups like the plain labels.
+    """
+
+    if columns is None:
+        columns = ['CombinationID', 'Qualifier'] + list(params.Label_Categories)
+
+    for column in columns:
+        if column not in pos:
+            continue
+
+        values = pos[column].astype(object)
+        values = values.where(values.isnull(), values.astype(str))
+
+        categories = set(params.Label_Categories.get(column, [])) | set(values.dropna().unique())
+        pos[column] = pd.Categorical(values, categories=sorted(categories))
+
+    return pos
 
 def generate_trade_pos(input_file, params):
 
-    excl_file = pd.ExcelFile(input_file)
+    source = open_input(input_file)
 
-    trades_pos = excl_file.parse('simm_input', converters={'Bucket': str, 'Label1': str, 'Label2': str, 'Amount': np.float64, 'AmountUSD': np.float64})
+    trades_pos = source.parse('simm_input', ['SensitivityID', 'ProductClass', 'RiskType', 'Qualifier', 'Bucket', 'Label1', 'Label2', 'AmountUSD'],
+                              converters={'Bucket': str, 'Label1': str, 'Label2': str, 'Amount': np.float64, 'AmountUSD': np.float64})
     trades_pos.dropna(how='all', inplace=True)
+    trades_pos = categorize_labels(trades_pos, params)
 
-    # Calculate risk classification
-    trades_pos = risk_classification(trades_pos, params)
-    trades_pos_no_classification = trades_pos[trades_pos.reason != 'Good'].copy()
-    trades_pos = trades_pos[trades_pos.reason == 'Good'].copy()
-
-    # Check input data quality
-    trades_pos_all = prep_data(trades_pos, params)
-    trades_pos_all = pd.concat([trades_pos_all, trades_pos_no_classification])
+    # Calculate risk classification and check input data quality
+    trades_pos_all = validate_trade_pos(trades_pos, params)
+    trades_pos_all = categorize_labels(trades_pos_all, params, ['RiskClass'])
     trades_pos_all.to_csv('all_trades_pos.csv', index=False)
 
     # Prepare input data
@@ -508,38 +793,105 @@ def generate_trade_pos(input_file, params):
 
     return trades_simm
 
-def find_sentivitiy_id(gp, trades_simm):
+def stream_trade_pos(input_file, params, chunk_size=100000, reject_file='rejected_trades_pos.csv'):
+    """Read a large CSV or CRIF sensitivity file in chunks and net the good sensitivities
+
+    Every chunk is classified and checked like generate_trade_pos, its rejected rows are appended
+    to reject_file and its good rows are netted into the running totals per risk factor, so memory
+    is bounded by the number of distinct risk factors rather than input rows. Rows without a
+    CombinationID column all belong to one combination named after the input file. SensitivityIDs
+    are kept in reject_file only, the netted risk factors have none.
+    """
 
-    case_ids = gp['SensitivityID']
+    factor_group = ['CombinationID', 'ProductClass', 'RiskType', 'Qualifier', 'Bucket', 'Label1', 'Label2', 'RiskClass']
+    input_columns = ['CombinationID', 'SensitivityID', 'ProductClass', 'RiskType', 'Qualifier', 'Bucket', 'Label1', 'Label2', 'AmountUSD']
+
+    if os.path.isfile(reject_file):
+        os.remove(reject_file)
+
+    case_name = os.path.splitext(os.path.basename(input_file))[0]
+
+    trades_simm = None
+    num_rows = 0
+    num_rejected = 0
+
+    chunks = pd.read_csv(input_file, chunksize=chunk_size, usecols=lambda column: column in input_columns,
+                         dtype={'SensitivityID': str, 'Bucket': str, 'Label1': str, 'Label2': str, 'AmountUSD': np.float64})
+
+    for trades_pos in chunks:
+        trades_pos.dropna(how='all', inplace=True)
+        num_rows = num_rows + len(trades_pos)
+
+        if 'CombinationID' not in trades_pos:
+            trades_pos['CombinationID'] = case_name
+
+        # Calculate risk classification and check input data quality
+        trades_pos = validate_trade_pos(trades_pos, params)
+
+        trades_pos_rejected = trades_pos[trades_pos.reason != 'Good']
+        if len(trades_pos_rejected) > 0:
+            num_rejected = num_rejected + len(trades_pos_rejected)
+            trades_pos_rejected.to_csv(reject_file, mode='a', header=not os.path.isfile(reject_file), index=False)
+
+        # Net good sensitivities into the running totals, empty labels standing in for missing ones
+        trades_pos = trades_pos[trades_pos.reason == 'Good'][factor_group + ['AmountUSD']]
+        trades_pos[factor_group] = trades_pos[factor_group].astype(object).fillna('')
+
+        if trades_simm is not None:
+            trades_pos = pd.concat([trades_simm, trades_pos])
+
+        trades_simm = trades_pos.groupby(factor_group, sort=False).agg({'AmountUSD': np.sum})
+        trades_simm.reset_index(inplace=True)
+
+    logger.info('Read {0} sensitivities, {1} rejected, netted into {2} risk factors'.format(
+        num_rows, num_rejected, 0 if trades_simm is None else len(trades_simm)))
+
+    if trades_simm is None:
+        return pd.DataFrame(columns=factor_group + ['AmountUSD'])
+
+    trades_simm[factor_group] = trades_simm[factor_group].replace('', np.nan)
+    trades_simm.AmountUSD.fillna(0, inplace=True)
+
+    return categorize_labels(trades_simm, params)
+
+class SensitivityIndex(object):
+    """SensitivityIDs of the netted sensitivities sorted once for prefix lookups of "All <prefix>" run cases"""
+
+    def __init__(self, sensitivity_ids):
+        self.ids = np.asarray(sensitivity_ids, dtype=object)
+        self.keys = np.array([str(id) for id in self.ids], dtype=object)
+        self.order = np.argsort(self.keys, kind='mergesort')
+        self.sorted_keys = self.keys[self.order]
+
+    def match_prefix(self, prefix):
+        """SensitivityIDs starting with prefix, in their original order"""
+
+        start = np.searchsorted(self.sorted_keys, prefix, side='left')
+        end = np.searchsorted(self.sorted_keys, prefix + u'\U0010ffff', side='right')
+
+        return self.ids[np.sort(self.order[start:end])]
+
+def find_sentivitiy_id(case_ids, sensitivity_index):
+    """SensitivityIDs of a run case entry: a list of ids, All, or All followed by a list of id prefixes"""
 
     if not re.search('All', case_ids) == None:
         case_ids = case_ids[re.search('All', case_ids).end():]
         case_ids = [id.strip() for id in case_ids.split(',')]
 
         if case_ids[0] == '':
-            case_ids = trades_simm.SensitivityID.values
+            case_ids = sensitivity_index.ids
         else:
-            case_all = []
-            for case in case_ids:
-                case_id = trades_simm[trades_simm.SensitivityID.str.match(case + '_')]
-                case_all.append(case_id)
-
-            case_all = pd.concat(case_all)
-            case_ids = case_all.SensitivityID.values
+            case_ids = np.concatenate([sensitivity_index.match_prefix(case + '_') for case in case_ids])
     else:
         case_ids = [id.strip() for id in case_ids.split(',')]
 
-    case_name = gp['CombinationID']
-    CombinationID = np.repeat(case_name, len(case_ids))
-    case_df = pd.DataFrame({'CombinationID': CombinationID, 'SensitivityID': case_ids})
-
-    return case_df
+    return np.asarray(case_ids, dtype=object)
 
 def generate_run_cases(input_file, trades_simm):
 
-    excl_file = pd.ExcelFile(input_file)
+    source = open_input(input_file)
 
-    run_cases = excl_file.parse('run_cases', converters={'Include': str})
+    run_cases = source.parse('run_cases', ['CombinationID', 'SensitivityID', 'Include'], converters={'Include': str})
 
     run_case_include = run_cases[run_cases.Include == 'x'].copy()
     if len(run_case_include) > 0:
@@ -552,20 +904,27 @@ def generate_run_cases(input_file, trades_simm):
     valid_sensitivities = []
 
     if len(run_case_all) > 0:
-        run_cases_expand = []
-        for index, row in run_case_all.iterrows():
-            run_case = find_sentivitiy_id(row, trades_simm)
-            run_cases_expand.append(run_case)
+        sensitivity_index = SensitivityIndex(trades_simm.SensitivityID.values)
+
+        case_ids = [find_sentivitiy_id(ids, sensitivity_index) for ids in run_case_all.SensitivityID.values]
+        num_ids = [len(ids) for ids in case_ids]
 
-        run_cases_expand = pd.concat(run_cases_expand)
+        # All run cases are expanded at once and joined to the sensitivities in a single merge
+        run_cases_expand = pd.DataFrame({'CombinationID': np.repeat(run_case_all.CombinationID.values, num_ids),
+                                         'SensitivityID': np.concatenate(case_ids)},
+                                        columns=['CombinationID', 'SensitivityID'])
         run_cases_expand = pd.merge(run_cases_expand, trades_simm, how='left')
 
+        # Every margin calculation groups on CombinationID
+        case_names = run_cases_expand.CombinationID.astype(str)
+        run_cases_expand['CombinationID'] = pd.Categorical(case_names, categories=np.sort(case_names.unique()))
+
         invalid_sensitivities = run_cases_expand[run_cases_expand.ProductClass.isnull()].copy()
         valid_sensitivities = run_cases_expand[run_cases_expand.ProductClass.notnull()].copy()
 
         if len(invalid_sensitivities) > 0:
-            for index, row in invalid_sensitivities.iterrows():
-                logger.info('{0} has no sensitivity {1}.'.format(row['CombinationID'], row['SensitivityID']))
+            for case, sensitivity_id in zip(invalid_sensitivities.CombinationID, invalid_sensitivities.SensitivityID):
+                logger.info('{0} has no sensitivity {1}.'.format(case, sensitivity_id))
 
     return valid_sensitivities
 
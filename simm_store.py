@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+import os
+import logging
+import pickle
+
+##############################
+# Setup Logging Configuration
+##############################
+logger = logging.getLogger(os.path.basename(__file__))
+if not len(logger.handlers):
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s|%(name)s === %(message)s ===', datefmt='%Y-%m-%d %I:%M:%S')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    file_handler = logging.FileHandler('log.txt')
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(logging.DEBUG)
+    logger.addHandler(file_handler)
+###############################
+
+# Columns stored as values, every other column is stored as integer codes into its categories
+Value_Columns = ['AmountUSD']
+
+class SensitivityStore(object):
+    """Run case sensitivities in memory-mapped numpy files shared by worker processes
+
+    Rows are grouped by CombinationID in run case order. Value columns are stored as float64 and
+    the other columns as int32 codes, -1 for missing labels, with their categories kept in a small
+    pickled header. Workers map the arrays read-only without copying them and materialize only the
+    rows of their combinations, located through the offsets array.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, 'header.pkl'), 'rb') as f:
+            header = pickle.load(f)
+
+        self.columns = header['columns']
+        self.categories = header['categories']
+        self.dtypes = header['dtypes']
+        self.cases = header['cases']
+
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.arrays = {}
+        for column in self.columns:
+            self.arrays[column] = np.load(self.array_file(path, column), mmap_mode='r')
+
+    @staticmethod
+    def array_file(path, column):
+        return os.path.join(path, '{0}.npy'.format(column))
+
+    @classmethod
+    def create(cls, run_cases, path):
+        """Write run cases to a store directory and open it"""
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # Combinations in order of first appearance, rows of a combination in their original order
+        case_idx, cases = pd.factorize(run_cases.CombinationID.values)
+        rows = np.argsort(case_idx, kind='mergesort')
+
+        offsets = np.zeros(len(cases) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(case_idx, minlength=len(cases)))
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+
+        categories = {}
+        dtypes = {}
+        for column in run_cases.columns:
+            values = run_cases[column]
+            dtypes[column] = values.dtype
+
+            if column in Value_Columns:
+                array = values.values.astype(np.float64)
+            else:
+                if not hasattr(values, 'cat'):
+                    values = values.astype('category')
+                categories[column] = values.cat.categories
+                array = values.cat.codes.values.astype(np.int32)
+
+            np.save(cls.array_file(path, column), array[rows])
+
+        header = {'columns': list(run_cases.columns), 'categories': categories, 'dtypes': dtypes,
+                  'cases': list(cases)}
+
+        with open(os.path.join(path, 'header.pkl'), 'wb') as f:
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        logger.info('Stored {0} sensitivities of {1} combinations in {2}'.format(len(run_cases), len(cases), path))
+
+        return cls(path)
+
+    def load(self, start=0, end=None):
+        """Run case rows of the combinations start to end, in store order"""
+
+        if end is None:
+            end = len(self.cases)
+
+        rows = slice(int(self.offsets[start]), int(self.offsets[end]))
+
+        run_cases = pd.DataFrame(index=np.arange(rows.stop - rows.start))
+        for column in self.columns:
+            array = self.arrays[column][rows]
+
+            if column in Value_Columns:
+                values = pd.Series(array, index=run_cases.index)
+            else:
+                values = pd.Series(pd.Categorical.from_codes(array, self.categories[column]), index=run_cases.index)
+
+            if values.dtype != self.dtypes[column]:
+                values = values.astype(self.dtypes[column])
+
+            run_cases[column] = values
+
+        return run_cases
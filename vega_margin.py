@@ -67,57 +67,57 @@ class VegaMargin(object):
         elif risk_class in ['Equity', 'Commodity']:
             factor_group = ['CombinationID', 'ProductClass', 'RiskType', 'Qualifier', 'Bucket', 'RiskClass']
 
-        pos_gp = pos.groupby(factor_group)
-        pos_vega = pos_gp.agg({'AmountUSD': np.sum})
+        # observed groups of categorical labels are sorted explicitly
+        pos_gp = pos.groupby(factor_group, observed=True)
+        pos_vega = pos_gp.agg({'AmountUSD': np.sum}).sort_index()
         pos_vega.reset_index(inplace=True)
 
         return pos_vega
 
-    def find_factor_idx(self, tenor_factor, tenors):
-        idx = 0
-
-        for tenor in tenors:
-            if tenor_factor == tenor:
-                return idx
-            else:
-                idx = idx + 1
-
-        return -1
-
-    def build_risk_factors(self, pos_gp, params):
+    def build_risk_factor_index(self, pos_gp, params):
+        """Risk factor of every netted row, -1 for rows outside the factor grid, and the number of factors"""
 
         risk_class = pos_gp.RiskClass.unique()[0]
 
         if risk_class == 'IR':
-            s = np.zeros(len(params.IR_Tenor))
+            num_factors = len(params.IR_Tenor)
 
-            for i, row in pos_gp.iterrows():
-                idx = self.find_factor_idx(row['Label1'], params.IR_Tenor)
-                if idx >= 0:
-                    s[idx] = row['AmountUSD']
+            idx = mlib.build_factor_index(pos_gp.Label1.values, params.IR_Tenor)
         elif risk_class in ['CreditQ', 'CreditNonQ']:
             if risk_class == 'CreditQ':
                 tenors = params.CreditQ_Tenor
             if risk_class == 'CreditNonQ':
                 tenors = params.CreditNonQ_Tenor
 
-            s = np.zeros(pos_gp.Qualifier.nunique() * len(tenors))
+            # qualifiers in sorted order, each with its tenors
+            qualifier_idx = pd.Categorical(pos_gp.Qualifier.values, categories=np.sort(pos_gp.Qualifier.unique())).codes
+            tenor_idx = mlib.build_factor_index(pos_gp.Label1.values, tenors)
 
-            for j in range(pos_gp.Qualifier.nunique()):
-                pos_gp_qualifier = pos_gp[pos_gp.Qualifier == pos_gp.sort_values(['Qualifier']).Qualifier.unique()[j]].copy()
+            num_factors = pos_gp.Qualifier.nunique() * len(tenors)
 
-                for i, row in pos_gp_qualifier.iterrows():
-                    idx = self.find_factor_idx(row['Label1'], tenors)
-                    if idx >= 0:
-                        s[idx + j * len(tenors)] = row['AmountUSD']
+            idx = np.where(tenor_idx >= 0, qualifier_idx * len(tenors) + tenor_idx, -1)
         else:
-            s = np.zeros(pos_gp.Qualifier.nunique())
+            num_factors = pos_gp.Qualifier.nunique()
+
+            # one factor per qualifier in sorted order, netting the tenors of an FX pair
+            idx = pd.Categorical(pos_gp.Qualifier.values, categories=np.sort(pos_gp.Qualifier.unique())).codes
+
+        return idx, num_factors
+
+    def build_risk_factors(self, pos_gp, params):
+        idx, num_factors = self.build_risk_factor_index(pos_gp, params)
+        valid = idx >= 0
 
-            for i, row in pos_gp.iterrows():
-                s[i] = row['AmountUSD']
+        s = np.zeros(num_factors)
+        np.add.at(s, idx[valid], pos_gp.AmountUSD.values[valid])
 
         return s
 
+    def build_risk_factor_scale(self, pos_gp, params, CR):
+        """dWS / ds of every risk factor, WS = VRW * s * CR"""
+
+        return self.build_risk_weights(pos_gp, params) * CR
+
     def build_risk_weights(self, pos_gp, params):
         risk_class = pos_gp.RiskClass.unique()[0]
 
@@ -136,126 +136,114 @@ class VegaMargin(object):
 
         return VRW
 
+    def classify_FX_pairs(self, curr_pairs, params):
+        """Risk_Group of every currency pair of a Series"""
+
+        curr_pairs = curr_pairs.astype(str)
+        curr1 = curr_pairs.str[0:3]
+        curr2 = curr_pairs.str[3:6]
+
+        is_material1 = curr1.isin(params.FX_Significantly_Material).values
+        is_material2 = curr2.isin(params.FX_Significantly_Material).values
+        is_frequent1 = curr1.isin(params.FX_Frequently_Traded).values
+        is_frequent2 = curr2.isin(params.FX_Frequently_Traded).values
+
+        conditions = [is_material1 & is_material2,
+                      (is_material1 & is_frequent2) | (is_frequent1 & is_material2),
+                      is_material1 | is_material2]
+
+        return np.select(conditions, ['C1_C1', 'C1_C2', 'C1_C3'], 'Others').astype(object)
+
+    def build_risk_group_table(self, params):
+        """Risk_Group lookup of every risk class: RiskClass -> (column, {value: Risk_Group}, default)
+
+        FX currency pairs are classified by classify_FX_pairs on every call.
+        """
+
+        IR_groups = {}
+        for curr in params.IR_Low_Vol_Curr:
+            IR_groups.setdefault(curr, 'Low volatility')
+        for curr in params.IR_Reg_Vol_Less_Well_Traded_Curr:
+            IR_groups.setdefault(curr, 'Regular volatility, less well-traded')
+        for curr in params.IR_Reg_Vol_Well_Traded_Curr:
+            IR_groups.setdefault(curr, 'Regular volatility, well-traded')
+
+        Equity_groups = mlib.build_bucket_groups([
+            (params.Equity_CR_Emerging_Large_Cap, 'Emerging Markets - Large Cap'),
+            (params.Equity_CR_Developed_Large_Cap, 'Developed Markets - Large Cap'),
+            (params.Equity_CR_Emerging_Small_Cap, 'Emerging Markets - Small Cap'),
+            (params.Equity_CR_Developed_Small_Cap, 'Developed Markets - Small Cap'),
+            (params.Equity_CR_Index_Funds_ETF, 'Indexeds, Funds, ETFs'),
+            (params.Equity_CR_Not_Classified, 'Not classified')])
+
+        Commodity_groups = mlib.build_bucket_groups([
+            (params.Commodity_CR_Coal, 'Coal'),
+            (params.Commodity_CR_Crude_Oil, 'Crude Oil'),
+            (params.Commodity_CR_Light_End, 'Light ends'),
+            (params.Commodity_CR_Middle_Distilates, 'Middle Distilates'),
+            (params.Commodity_CR_Heavy_Distilates, 'Heavy Distilates'),
+            (params.Commodity_CR_NA_Natual_Gas, 'NA Natural gas'),
+            (params.Commodity_CR_EU_Natual_Gas, 'EU Natual gas'),
+            (params.Commodity_CR_NA_Power, 'NA Power, On-Peak'),
+            (params.Commodity_CR_EU_Power, 'EU Power, On-Peak'),
+            (params.Commodity_CR_Freight, 'Freight, Dry or Wet'),
+            (params.Commodity_CR_Base_Metals, 'Base metals'),
+            (params.Commodity_CR_Precious_Metals, 'Precious Metals'),
+            (params.Commodity_CR_Grains, 'Grains'),
+            (params.Commodity_CR_Softs, 'Softs'),
+            (params.Commodity_CR_Livestock, 'Livestock'),
+            (params.Commodity_CR_Others, 'Other / Diversified Commodity Indices')])
+
+        return {
+            'IR': ('Qualifier', IR_groups, 'High volatility'),
+            'CreditQ': ('RiskClass', {}, 'Qualifying'),
+            'CreditNonQ': ('RiskClass', {}, 'Non Qualifying'),
+            'Equity': ('Bucket', Equity_groups, None),
+            'Commodity': ('Bucket', Commodity_groups, None),
+            'FX': ('Qualifier', {}, lambda curr_pairs: self.classify_FX_pairs(curr_pairs, params)),
+        }
+
     def calculate_risk_group(self, gp, params):
-        if gp['RiskClass'] == 'IR':
-            if gp['Qualifier'] in params.IR_Low_Vol_Curr:
-                risk_group = 'Low volatility'
-            elif gp['Qualifier'] in params.IR_Reg_Vol_Less_Well_Traded_Curr:
-                risk_group = 'Regular volatility, less well-traded'
-            elif gp['Qualifier'] in params.IR_Reg_Vol_Well_Traded_Curr:
-                risk_group = 'Regular volatility, well-traded'
-            else:
-                risk_group = 'High volatility'
-
-        elif gp['RiskClass'] == 'CreditQ':
-            risk_group = 'Qualifying'
-
-        elif gp['RiskClass'] == 'CreditNonQ':
-            risk_group = 'Non Qualifying'
-
-        elif gp['RiskClass'] == 'Equity':
-            if gp['Bucket'] in params.Equity_CR_Emerging_Large_Cap:
-                risk_group = 'Emerging Markets - Large Cap'
-            elif gp['Bucket'] in params.Equity_CR_Developed_Large_Cap:
-                risk_group = 'Developed Markets - Large Cap'
-            elif gp['Bucket'] in params.Equity_CR_Emerging_Small_Cap:
-                risk_group = 'Emerging Markets - Small Cap'
-            elif gp['Bucket'] in params.Equity_CR_Developed_Small_Cap:
-                risk_group = 'Developed Markets - Small Cap'
-            elif gp['Bucket'] in params.Equity_CR_Index_Funds_ETF:
-                risk_group = 'Indexeds, Funds, ETFs'
-            elif gp['Bucket'] in params.Equity_CR_Not_Classified:
-                risk_group = 'Not classified'
-
-        elif gp['RiskClass'] == 'Commodity':
-            if gp['Bucket'] in params.Commodity_CR_Coal:
-                risk_group = 'Coal'
-            elif gp['Bucket'] in params.Commodity_CR_Crude_Oil:
-                risk_group = 'Crude Oil'
-            elif gp['Bucket'] in params.Commodity_CR_Light_End:
-                risk_group = 'Light ends'
-            elif gp['Bucket'] in params.Commodity_CR_Middle_Distilates:
-                risk_group = 'Middle Distilates'
-            elif gp['Bucket'] in params.Commodity_CR_Heavy_Distilates:
-                risk_group = 'Heavy Distilates'
-            elif gp['Bucket'] in params.Commodity_CR_NA_Natual_Gas:
-                risk_group = 'NA Natural gas'
-            elif gp['Bucket'] in params.Commodity_CR_EU_Natual_Gas:
-                risk_group = 'EU Natual gas'
-            elif gp['Bucket'] in params.Commodity_CR_NA_Power:
-                risk_group = 'NA Power, On-Peak'
-            elif gp['Bucket'] in params.Commodity_CR_EU_Power:
-                risk_group = 'EU Power, On-Peak'
-            elif gp['Bucket'] in params.Commodity_CR_Freight:
-                risk_group = 'Freight, Dry or Wet'
-            elif gp['Bucket'] in params.Commodity_CR_Base_Metals:
-                risk_group = 'Base metals'
-            elif gp['Bucket'] in params.Commodity_CR_Precious_Metals:
-                risk_group = 'Precious Metals'
-            elif gp['Bucket'] in params.Commodity_CR_Grains:
-                risk_group = 'Grains'
-            elif gp['Bucket'] in params.Commodity_CR_Softs:
-                risk_group = 'Softs'
-            elif gp['Bucket'] in params.Commodity_CR_Livestock:
-                risk_group = 'Livestock'
-            elif gp['Bucket'] in params.Commodity_CR_Others:
-                risk_group = 'Other / Diversified Commodity Indices'
-
-        elif gp['RiskClass'] == 'FX':
-            curr1 = gp['Qualifier'][0:3]
-            curr2 = gp['Qualifier'][3:6]
-
-            if curr1 in params.FX_Significantly_Material and curr2 in params.FX_Significantly_Material:
-                risk_group = 'C1_C1'
-            elif (curr1 in params.FX_Significantly_Material and curr2 in params.FX_Frequently_Traded) or \
-                    (curr1 in params.FX_Frequently_Traded and curr2 in params.FX_Significantly_Material):
-                risk_group = 'C1_C2'
-            elif curr1 in params.FX_Significantly_Material or curr2 in params.FX_Significantly_Material:
-                risk_group = 'C1_C3'
-            else:
-                risk_group = 'Others'
-
-        gp['Risk_Group'] = risk_group
+        table = mlib.load_risk_group_table(self, params)
+        gp['Risk_Group'] = mlib.map_risk_group(gp, table)
 
         return gp
 
-    def calculate_CR_Threshold(self, gp, params):
+    def calculate_CR_Threshold(self, pos, params):
 
-        risk_group = gp['RiskClass'].unique()[0]
+        risk_group = pos['RiskClass'].unique()[0]
 
         if risk_group == 'IR':
-            thrd = params.IR_CR_Thrd[params.IR_CR_Thrd.Type == 'Vega'].copy()
+            thrd = params.IR_CR_Thrd[params.IR_CR_Thrd.Type == 'Vega']
 
         elif risk_group == 'CreditQ':
-            thrd = params.CreditQ_CR_Thrd[params.CreditQ_CR_Thrd.Type == 'Vega'].copy()
+            thrd = params.CreditQ_CR_Thrd[params.CreditQ_CR_Thrd.Type == 'Vega']
 
         elif risk_group == 'CreditNonQ':
-            thrd = params.CreditNonQ_CR_Thrd[params.CreditNonQ_CR_Thrd.Type == 'Vega'].copy()
+            thrd = params.CreditNonQ_CR_Thrd[params.CreditNonQ_CR_Thrd.Type == 'Vega']
 
         elif risk_group == 'Equity':
-            thrd = params.Equity_CR_Thrd[params.Equity_CR_Thrd.Type == 'Vega'].copy()
+            thrd = params.Equity_CR_Thrd[params.Equity_CR_Thrd.Type == 'Vega']
 
         elif risk_group == 'Commodity':
-            thrd = params.Commodity_CR_Thrd[params.Commodity_CR_Thrd.Type == 'Vega'].copy()
+            thrd = params.Commodity_CR_Thrd[params.Commodity_CR_Thrd.Type == 'Vega']
 
         elif risk_group == 'FX':
-            thrd = params.FX_CR_Thrd[params.FX_CR_Thrd.Type == 'Vega'].copy()
+            thrd = params.FX_CR_Thrd[params.FX_CR_Thrd.Type == 'Vega']
 
-        gp = pd.merge(gp, thrd[['Risk_Group', 'CR_THR']], how='left')
+        thrd = pd.Series(thrd.CR_THR.values, index=thrd.Risk_Group.values)
+        pos['CR_THR'] = pos.Risk_Group.map(thrd).values
 
-        return gp
+        return pos
 
-    def margin_risk_group(self, gp, params):
+    def build_weighted_risk(self, gp, params):
 
         risk_class = gp.RiskClass.unique()[0]
 
         if risk_class in ['IR', 'FX']:
-            logger.info('Calculate {0} Vega Margin for {1}'.format(risk_class, gp.Qualifier.unique()))
+            logger.info('Calculate {0} Vega Margin for {1}'.format(risk_class, list(gp.Qualifier.unique())))
         else:
-            logger.info('Calculate {0} Vega Margin for {1}'.format(risk_class, gp.Bucket.unique()))
-
-        gp = gp.apply(self.calculate_risk_group, axis=1, params=params)
-        gp = self.calculate_CR_Threshold(gp, params)
+            logger.info('Calculate {0} Vega Margin for {1}'.format(risk_class, list(gp.Bucket.unique())))
 
         s = self.build_risk_factors(gp, params)
         RW = self.build_risk_weights(gp, params)
@@ -263,10 +251,13 @@ class VegaMargin(object):
 
         WS = RW * s * CR
 
-        Corr = mlib.build_in_bucket_correlation(gp, params, self.margin_type(), CR)
+        Corr = mlib.build_in_bucket_structure(gp, params, self.margin_type(), CR)
+
+        return gp, WS, CR, Corr
 
-        K = np.mat(WS) * np.mat(Corr) * np.mat(np.reshape(WS, (len(WS), 1)))
-        K = math.sqrt(K.item(0))
+    def build_margin_risk_group(self, gp, WS, CR, K):
+
+        risk_class = gp.RiskClass.unique()[0]
 
         ret = gp[['CombinationID', 'ProductClass', 'RiskType', 'RiskClass']].copy()
         ret.drop_duplicates(inplace=True)
@@ -285,4 +276,4 @@ class VegaMargin(object):
         else:
             ret['Group'] = gp['Bucket'].unique()[0]
 
-        return ret
\ No newline at end of file
+        return ret